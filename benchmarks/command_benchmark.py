@@ -0,0 +1,298 @@
+import os
+import io
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import builtins
+import datetime
+import tempfile
+import threading
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import calendarMe
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'command_fixtures.json')
+SERVICES = ['openai', 'calendar', 'weather', 'geocode']
+
+round_trips = {service: 0 for service in SERVICES}
+round_trips_lock = threading.Lock()
+latencies = {'openai': 0.8, 'openai_token': 0.01, 'calendar': 0.15, 'weather': 0.1, 'geocode': 0.2}
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def round_trip(service):
+    with round_trips_lock:
+        round_trips[service] += 1
+    time.sleep(latencies[service])
+
+def fill_dates(text):
+    today = datetime.date.today()
+    for name, days in [('today', 0), ('tomorrow', 1)]:
+        text = text.replace('{' + name + '}', (today + datetime.timedelta(days=days)).isoformat())
+    return text
+
+class FakeResponse(dict):
+    def __init__(self, status):
+        super().__init__(status=str(status))
+        self.status = status
+
+class FakeHttpError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.resp = FakeResponse(status)
+        self.content = b''
+
+class FakeRequest:
+    def __init__(self, calendar, method, arguments):
+        self.calendar = calendar
+        self.method = method
+        self.arguments = arguments
+        self.headers = {}
+
+    def execute(self, **kwargs):
+        round_trip('calendar')
+        return self.calendar.handle(self)
+
+class FakeBatch:
+    def __init__(self, calendar, callback):
+        self.calendar = calendar
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request, request_id))
+
+    def execute(self):
+        round_trip('calendar')
+        for request, request_id in self.requests:
+            try:
+                response = self.calendar.handle(request)
+            except FakeHttpError as error:
+                self.callback(request_id, None, error)
+            else:
+                self.callback(request_id, response, None)
+
+class FakeEvents:
+    def __init__(self, calendar):
+        self.calendar = calendar
+
+    def __getattr__(self, method):
+        return lambda **arguments: FakeRequest(self.calendar, method, arguments)
+
+class FakeCalendar:
+    # Stands in for the Calendar API service, including batches, sync tokens and etags
+    def __init__(self, fixture_events):
+        self.events_by_id = {}
+        self.changes = []
+        self.lock = threading.Lock()
+        today = datetime.date.today()
+        for number, fixture in enumerate(fixture_events, start=1):
+            day = (today + datetime.timedelta(days=fixture["day"])).isoformat()
+            if fixture.get('all_day'):
+                start, end = {'date': day}, {'date': (today + datetime.timedelta(days=fixture["day"] + 1)).isoformat()}
+            else:
+                start = {'dateTime': f"{day}T{fixture['start']}:00+02:00", 'timeZone': 'Etc/GMT-2'}
+                end = {'dateTime': f"{day}T{fixture['end']}:00+02:00", 'timeZone': 'Etc/GMT-2'}
+            event = {'summary': fixture['summary'], 'description': fixture['description'], 'start': start, 'end': end,
+                     'reminders': {'useDefault': True}}
+            if fixture.get('location'):
+                event['location'] = fixture['location']
+            self.save(dict(event, id=f"fixture{number:04d}"))
+
+    def save(self, event):
+        event['etag'] = f"\"{len(self.changes)}\""
+        event['htmlLink'] = f"https://calendar.google.com/event?eid={event['id']}"
+        self.events_by_id[event['id']] = event
+        self.changes.append(event['id'])
+        return event
+
+    def events(self):
+        return FakeEvents(self)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+    def freebusy(self):
+        return types.SimpleNamespace(query=lambda body, fields=None: FakeRequest(self, 'freebusy', {'body': body}))
+
+    def handle(self, request):
+        arguments = request.arguments
+        with self.lock:
+            event = self.events_by_id.get(arguments.get('eventId'))
+            if request.method == 'list':
+                changed = dict.fromkeys(self.changes[int(arguments.get('syncToken') or 0):])
+                items = [self.events_by_id.get(event_id, {'id': event_id, 'status': 'cancelled'}) for event_id in changed]
+                return json.loads(json.dumps({'items': items, 'nextSyncToken': str(len(self.changes))}))
+            if request.method == 'freebusy':
+                return self.busy_times(arguments['body'])
+            if request.method == 'insert':
+                if arguments['body'].get('id') in self.events_by_id:
+                    raise FakeHttpError(409)
+                body = dict(arguments['body'])
+                body.setdefault('id', f"created{len(self.changes):04d}")
+                return dict(self.save(body))
+            if event is None:
+                raise FakeHttpError(404)
+            if request.headers.get('If-Match', event['etag']) != event['etag']:
+                raise FakeHttpError(412)
+            if request.method == 'get':
+                return dict(event)
+            if request.method == 'patch':
+                return dict(self.save(dict(event, **arguments['body'])))
+            if request.method == 'delete':
+                del self.events_by_id[event['id']]
+                self.changes.append(event['id'])
+                return ''
+        raise FakeHttpError(400)
+
+    def busy_times(self, body):
+        # Only the signed-in calendar is known here, as with a teammate who hasn't shared theirs
+        start, end = calendarMe.time_to_timestamp(body['timeMin']), calendarMe.time_to_timestamp(body['timeMax'])
+        busy = [{'start': event['start']['dateTime'], 'end': event['end']['dateTime']} for event in self.events_by_id.values()
+                if 'dateTime' in event['start'] and calendarMe.time_to_timestamp(event['start']['dateTime']) < end
+                and calendarMe.time_to_timestamp(event['end']['dateTime']) > start]
+        return {'calendars': {item['id']: {'busy': busy} if item['id'] == 'primary' else {'errors': [{'reason': 'notFound'}], 'busy': []}
+                              for item in body['items']}}
+
+class FakeHTTPResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+def fake_requests(fixtures):
+    def get(url, params=None, headers=None, timeout=None):
+        if 'nominatim' in url:
+            round_trip('geocode')
+            return FakeHTTPResponse(fixtures['geocode'].get(params.get('q', '').lower(), fixtures['geocode']['default']))
+        round_trip('weather')
+        hours = [f"{params['start_date']}T{hour:02d}:00" for hour in range(24)]
+        return FakeHTTPResponse({'hourly': dict(fixtures['forecast'], time=hours)})
+    return types.SimpleNamespace(get=get, exceptions=types.SimpleNamespace(RequestException=OSError))
+
+class FakeOpenAI:
+    # Replays the recorded reply whose match text appears in the latest prompt
+    api_key = 'fixture'
+
+    def __init__(self):
+        self.responses = []
+        self.ChatCompletion = types.SimpleNamespace(create=self.create)
+
+    def reply_for(self, messages):
+        prompt = [message['content'] for message in messages if message['role'] == 'user'][-1]
+        for recorded in self.responses:
+            if recorded['match'] in prompt:
+                return fill_dates(recorded['response'])
+        raise RuntimeError(f"No recorded response for prompt: {prompt[:120]}")
+
+    def create(self, model, messages, temperature, stream=False):
+        response = self.reply_for(messages)
+        round_trip('openai')
+        if stream:
+            return self.stream(response)
+        time.sleep(calendarMe.estimate_tokens(response) * latencies['openai_token'])
+        return {'choices': [{'message': {'content': response}}],
+                'usage': {'prompt_tokens': sum(calendarMe.estimate_tokens(message['content']) for message in messages),
+                          'completion_tokens': calendarMe.estimate_tokens(response)}}
+
+    def stream(self, response):
+        for i in range(0, len(response), 16):
+            time.sleep(4 * latencies['openai_token'])
+            yield {'choices': [{'delta': {'content': response[i:i + 16]}}]}
+
+def reset_state(workdir):
+    if calendarMe.store_connection is not None:
+        calendarMe.store_connection.close()
+    calendarMe.store_connection = None
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    calendarMe.STORE_PATH = os.path.join(workdir, 'calendarMe.db')
+    calendarMe.WEATHER_CACHE_PATH = os.path.join(workdir, 'weather_cache.json')
+    calendarMe.GEOCODE_CACHE_PATH = os.path.join(workdir, 'geocode_cache.json')
+    calendarMe.forecast_cache = None
+    calendarMe.geocode_cache = None
+    calendarMe.last_store_sync.clear()
+    calendarMe.streamed_objects.clear()
+    calendarMe.forget_prefetches()
+    # Every run starts with full rate limit buckets, as a fresh session would
+    for service_name, (rate, capacity) in calendarMe.RATE_LIMITS.items():
+        calendarMe.rate_limiters[service_name] = calendarMe.TokenBucket(rate, capacity)
+    for service in SERVICES:
+        round_trips[service] = 0
+
+def scripted_input(command):
+    queued = [command['name'], fill_dates(command['plan'])]
+    def answer(prompt=""):
+        if queued:
+            return queued.pop(0)
+        for question, reply in command['answers'].items():
+            if prompt.startswith(question):
+                return reply
+        return ""
+    return answer
+
+def run_command(command, fixtures, openai, workdir, verbose):
+    reset_state(workdir)
+    service = FakeCalendar(fixtures['calendar'])
+    openai.responses = command['responses']
+    builtins.input = scripted_input(command)
+    calendarMe.reset_token_usage()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        started = time.perf_counter()
+        events_json = calendarMe.manual_planning_main(service)
+        if events_json is not None:
+            calendarMe.add_events_to_calendar(service, events_json)
+        elapsed = time.perf_counter() - started
+    return elapsed, dict(round_trips), dict(calendarMe.TOKEN_USAGE)
+
+def report(name, results):
+    times = [elapsed for elapsed, trips, tokens in results]
+    trips = {service: sum(result[1][service] for result in results) / len(results) for service in SERVICES}
+    prompt_tokens = sum(result[2]['prompt'] for result in results) / len(results)
+    completion_tokens = sum(result[2]['completion'] for result in results) / len(results)
+    print(f"{name:<14} p50 {percentile(times, 0.5) * 1000:7.0f} ms   p95 {percentile(times, 0.95) * 1000:7.0f} ms   "
+          + "  ".join(f"{service} {trips[service]:.1f}" for service in SERVICES)
+          + f"   tokens {prompt_tokens:.0f}+{completion_tokens:.0f}")
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description="Benchmark each command against recorded Calendar, OpenAI and weather responses.")
+    argument_parser.add_argument('--runs', type=int, default=5, help="times each command is run.")
+    argument_parser.add_argument('--commands', nargs='*', help="only run these commands, e.g. MAKE EDIT.")
+    argument_parser.add_argument('--latency-scale', type=float, default=1.0,
+                                 help="multiplies every injected latency (0 measures CalendarMe's own overhead).")
+    argument_parser.add_argument('--no-stream', action='store_true', help="benchmark without streamed responses.")
+    argument_parser.add_argument('--llm-cache', action='store_true', help="let repeated runs reuse cached LLM responses.")
+    argument_parser.add_argument('--free-busy', action='store_true', help="find free time in GET THEN MAKE from busy times alone.")
+    argument_parser.add_argument('--verbose', action='store_true', help="show the output of every command.")
+    arguments = argument_parser.parse_args()
+
+    with open(FIXTURES_PATH, encoding='utf-8') as f:
+        fixtures = json.load(f)
+    for key in latencies:
+        latencies[key] = latencies[key] * arguments.latency_scale
+    openai = FakeOpenAI()
+    calendarMe.lazy_modules['openai'] = openai
+    calendarMe.lazy_modules['requests'] = fake_requests(fixtures)
+    calendarMe.stream_responses = not arguments.no_stream
+    calendarMe.llm_cache_enabled = arguments.llm_cache
+    calendarMe.free_busy_only = arguments.free_busy
+    workdir = os.path.join(tempfile.gettempdir(), 'calendarMe_benchmark')
+
+    print(f"{arguments.runs} run(s) per command, latency scale {arguments.latency_scale}, round trips and tokens are per run:")
+    for command in fixtures['commands']:
+        if arguments.commands and command['name'] not in arguments.commands:
+            continue
+        results = [run_command(command, fixtures, openai, workdir, arguments.verbose) for _ in range(arguments.runs)]
+        report(command['name'], results)
+    shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import time
+import datetime
+import argparse
+import builtins
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import calendarMe
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'time_window_corpus.json')
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run_local(corpus, repeats):
+    now = datetime.datetime.strptime(corpus['now'], '%Y-%m-%d %H:%M')
+    hits, correct, wrong, deferred = 0, 0, [], 0
+    latencies = []
+    for case in corpus['cases']:
+        for _ in range(repeats):
+            started = time.perf_counter()
+            start_time, end_time, confidence = calendarMe.local_time_window(case['prompt'], now)
+            latencies.append(time.perf_counter() - started)
+        confident = confidence >= calendarMe.LOCAL_TIME_WINDOW_CONFIDENCE
+        if not confident:
+            deferred = deferred + 1
+            if case['expected'] is not None:
+                wrong.append((case['prompt'], "deferred to GPT", case['expected']))
+            continue
+        hits = hits + 1
+        if case['expected'] == [start_time, end_time]:
+            correct = correct + 1
+        else:
+            wrong.append((case['prompt'], [start_time, end_time], case['expected']))
+
+    print(f"Local parser on {len(corpus['cases'])} prompts (now = {corpus['now']}):")
+    print(f"  Resolved locally: {hits} ({hits / len(corpus['cases']):.0%}), of which correct: {correct}")
+    print(f"  Deferred to GPT: {deferred}")
+    print(f"  Latency: p50 {percentile(latencies, 0.5) * 1e6:.0f} µs, p95 {percentile(latencies, 0.95) * 1e6:.0f} µs")
+    for prompt, got, expected in wrong:
+        print(f"  Mismatch: \"{prompt}\": got {got}, expected {expected}")
+
+def run_gpt(corpus):
+    calendarMe.local_time_windows = False
+    calendarMe.stream_responses = False
+    builtins.input = lambda message="": ""
+    latencies = []
+    for case in corpus['cases']:
+        started = time.perf_counter()
+        calendarMe.time_window_from_prompt(case['prompt'])
+        latencies.append(time.perf_counter() - started)
+    print(f"GPT path on {len(corpus['cases'])} prompts:")
+    print(f"  Latency: p50 {percentile(latencies, 0.5) * 1000:.0f} ms, p95 {percentile(latencies, 0.95) * 1000:.0f} ms")
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description="Benchmark the local time window parser against the corpus.")
+    argument_parser.add_argument('--repeats', type=int, default=100, help="times each prompt is parsed when timing.")
+    argument_parser.add_argument('--gpt', action='store_true',
+                                 help="also time the GPT path (needs openai.txt, sends one request per prompt).")
+    arguments = argument_parser.parse_args()
+    with open(CORPUS_PATH) as f:
+        corpus = json.load(f)
+    run_local(corpus, arguments.repeats)
+    if arguments.gpt:
+        run_gpt(corpus)
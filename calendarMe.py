@@ -1,23 +1,403 @@
+import time
+startup_started = time.perf_counter()
 import re
 import datetime
-from dateutil import parser
 import os.path
-import pytz
-from tzlocal import get_localzone
-import openai
-with open('openai.txt') as f:
-    openai.api_key = f.read()
 import json
-import time
+import sqlite3
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import importlib
+import sys
+import argparse
+import hashlib
+import random
+import copy
+import uuid
+import email.utils
+from collections import OrderedDict, deque
+import contextlib
+import atexit
+
+SCOPES = ['https://www.googleapis.com/auth/calendar.events', 'https://www.googleapis.com/auth/calendar.freebusy']
+DISCOVERY_CACHE_PATH = 'calendar_v3_discovery.json'
+STARTUP_TIMINGS = []
+startup_profile = False
+lazy_modules = {}
+lazy_import_lock = threading.Lock()
+
+def record_startup_phase(phase, started):
+    STARTUP_TIMINGS.append((phase, time.perf_counter() - started))
+    if startup_profile and phase.startswith("import "):
+        print(f"[startup profile] {phase}: {(time.perf_counter() - started) * 1000:.0f} ms")
+
+def lazy_import(module_name):
+    if module_name not in lazy_modules:
+        with lazy_import_lock:
+            if module_name not in lazy_modules:
+                started = time.perf_counter()
+                lazy_modules[module_name] = importlib.import_module(module_name)
+                record_startup_phase(f"import {module_name}", started)
+    return lazy_modules[module_name]
+
+def get_openai():
+    openai = lazy_import('openai')
+    if not openai.api_key:
+        with open('openai.txt') as f:
+            openai.api_key = f.read()
+    return openai
+
+def http_error():
+    return lazy_import('googleapiclient.errors').HttpError
+
+TRACE_SPAN_LIMIT = 20000
+SPANS = deque(maxlen=TRACE_SPAN_LIMIT)
+span_state = threading.local()
+current_command = None
+
+@contextlib.contextmanager
+def trace_span(service_name, name, **attributes):
+    # Records how long a call took along with whatever the code inside adds through annotate_span
+    span = dict(attributes, service=service_name, name=name, command=getattr(command_state, 'command', None) or current_command,
+                thread=threading.get_ident(), retries=0)
+    stack = span_state.__dict__.setdefault('stack', [])
+    stack.append(span)
+    started = time.perf_counter()
+    try:
+        yield span
+    except BaseException as error:
+        span['error'] = type(error).__name__
+        raise
+    finally:
+        span['start'] = started - startup_started
+        span['duration'] = time.perf_counter() - started
+        stack.pop()
+        SPANS.append(span)
+
+def annotate_span(**attributes):
+    stack = getattr(span_state, 'stack', None)
+    if stack:
+        stack[-1].update(attributes)
+
+def print_trace_stats():
+    commands = {}
+    for span in list(SPANS):
+        command = commands.setdefault(span['command'] or "outside commands", {})
+        group = command.setdefault((span['service'], span['name']), {
+            'calls': 0, 'seconds': 0, 'retries': 0, 'cache_hits': 0, 'tokens': 0, 'bytes': 0})
+        group['calls'] += 1
+        group['seconds'] += span['duration']
+        group['retries'] += span['retries']
+        group['cache_hits'] += 1 if span.get('cache_hit') else 0
+        group['tokens'] += span.get('prompt_tokens', 0) + span.get('completion_tokens', 0)
+        group['bytes'] += span.get('request_bytes', 0) + span.get('response_bytes', 0)
+    if not commands:
+        print("No calls recorded yet.")
+    for command, groups in commands.items():
+        print(f"\n{command}:")
+        for (service_name, name), group in sorted(groups.items(), key=lambda item: -item[1]['seconds']):
+            print(f"  {service_name} {name}: {group['calls']} call(s), {group['seconds'] * 1000:.0f} ms total, "
+                  f"{group['seconds'] / group['calls'] * 1000:.0f} ms average, {group['retries']} retries, "
+                  f"{group['cache_hits']} cache hits, {group['tokens']} tokens, {group['bytes']} bytes")
+
+def export_trace(path):
+    spans = list(SPANS)
+    with open(path + '.tmp', 'w') as f:
+        if path.endswith('.jsonl'):
+            for span in spans:
+                f.write(json.dumps(span) + "\n")
+        else:
+            # Chrome trace format, for chrome://tracing or Perfetto
+            json.dump({'traceEvents': [{
+                'name': f"{span['service']} {span['name']}", 'cat': span['service'], 'ph': 'X', 'pid': 1,
+                'tid': span['thread'], 'ts': span['start'] * 1e6, 'dur': span['duration'] * 1e6,
+                'args': {key: value for key, value in span.items() if key not in ['start', 'duration', 'thread']}
+            } for span in spans]}, f)
+    os.replace(path + '.tmp', path)
+    print(f"Saved {len(spans)} trace spans to {path}.")
+
+RETRYABLE_STATUSES = [429, 500, 502, 503, 504]
+RETRYABLE_ERROR_NAMES = ['Timeout', 'APIConnectionError', 'ServiceUnavailableError', 'TryAgain', 'RateLimitError']
+RATE_LIMITS = {
+    'openai': (3, 3),
+    'calendar': (10, 10),
+    'weather': (5, 5),
+    'geocode': (1, 1),
+}
+MAX_RETRIES = {'openai': 3, 'calendar': 4, 'weather': 3, 'geocode': 2}
+BACKOFF_BASE = 1
+BACKOFF_MAX = 32
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+rate_limiters = {service_name: TokenBucket(rate, capacity) for service_name, (rate, capacity) in RATE_LIMITS.items()}
+TENANT_SHARE = 0.5
+TENANT_LIMITER_LIMIT = 256
+tenant_limiters = OrderedDict()
+tenant_limiters_lock = threading.Lock()
+
+def tenant_limiter(service_name):
+    # Each user gets at most a share of every quota, so one busy user can't starve the rest
+    user = active_user()
+    if user is None:
+        return None
+    with tenant_limiters_lock:
+        bucket = tenant_limiters.pop((user, service_name), None)
+        if bucket is None:
+            rate, capacity = RATE_LIMITS[service_name]
+            bucket = TokenBucket(rate * TENANT_SHARE, max(1, capacity * TENANT_SHARE))
+        tenant_limiters[(user, service_name)] = bucket
+        while len(tenant_limiters) > TENANT_LIMITER_LIMIT:
+            tenant_limiters.popitem(last=False)
+        return bucket
+
+class RetryableResponse(Exception):
+    def __init__(self, resp, content):
+        super().__init__(f"HTTP {resp.status}")
+        self.resp = resp
+        self.content = content
+
+def parse_retry_after(retry_after):
+    if retry_after is None:
+        return None
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        try:
+            return max(0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def classify_error(error):
+    status = None
+    retry_after = None
+    if hasattr(getattr(error, 'resp', None), 'status'):
+        status = error.resp.status
+        retry_after = error.resp.get('retry-after')
+        if status == 403 and b'ratelimitexceeded' in (getattr(error, 'content', b'') or b'').lower():
+            status = 429
+    elif hasattr(getattr(error, 'response', None), 'status_code'):
+        status = error.response.status_code
+        retry_after = error.response.headers.get('Retry-After')
+    elif getattr(error, 'http_status', None) is not None:
+        status = error.http_status
+        retry_after = (getattr(error, 'headers', None) or {}).get('retry-after')
+    if status is not None:
+        return status in RETRYABLE_STATUSES, parse_retry_after(retry_after)
+    if type(error).__name__ in RETRYABLE_ERROR_NAMES:
+        return True, None
+    return isinstance(error, OSError), None
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def call_with_backoff(service_name, function, *args, **kwargs):
+    bucket = rate_limiters[service_name]
+    user_bucket = tenant_limiter(service_name)
+    attempt = 0
+    with trace_span(service_name, function.__name__) as span:
+        while True:
+            if user_bucket is not None:
+                user_bucket.acquire()
+            bucket.acquire()
+            try:
+                return function(*args, **kwargs)
+            except Exception as error:
+                retryable, retry_after = classify_error(error)
+                if not retryable or attempt >= MAX_RETRIES[service_name]:
+                    raise
+                if retry_after is not None:
+                    bucket.pause(retry_after)
+                    delay = retry_after
+                else:
+                    delay = backoff_delay(attempt)
+                attempt = attempt + 1
+                span['retries'] = attempt
+                print(f"\nA {service_name} request failed ({error}). Retrying in {delay:.1f} seconds ({attempt}/{MAX_RETRIES[service_name]})...")
+                time.sleep(delay)
+
+def calendar_operation(method, uri):
+    path = uri.split('?')[0].split('/calendar/v3')[-1]
+    path = re.sub(r'/events/[^/]+', '/events/{id}', re.sub(r'/calendars/[^/]+', '/calendars/{calendar}', path))
+    return f"{method} {path}"
+
+class ScheduledHttp:
+    def __init__(self, http, service_name='calendar'):
+        self.http = http
+        self.service_name = service_name
+
+    def request(self, *args, **kwargs):
+        uri = kwargs.get('uri', args[0] if args else '')
+        method = kwargs.get('method', args[1] if len(args) > 1 else 'GET')
+        body = kwargs.get('body', args[2] if len(args) > 2 else None)
+
+        def send():
+            resp, content = self.http.request(*args, **kwargs)
+            annotate_span(name=calendar_operation(method, uri), status=resp.status,
+                          request_bytes=len(body or ''), response_bytes=len(content or ''))
+            if resp.status in RETRYABLE_STATUSES or (resp.status == 403 and b'ratelimitexceeded' in content.lower()):
+                raise RetryableResponse(resp, content)
+            return resp, content
+        try:
+            return call_with_backoff(self.service_name, send)
+        except RetryableResponse as error:
+            return error.resp, error.content
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+def save_credentials(creds, token_path='token.json'):
+    with open(token_path + '.tmp', 'w') as token:
+        token.write(creds.to_json())
+    os.replace(token_path + '.tmp', token_path)
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+def load_credentials(token_path='token.json', interactive=True):
+    Credentials = lazy_import('google.oauth2.credentials').Credentials
+    creds = None
+    if os.path.exists(token_path):
+        creds = Credentials.from_authorized_user_file(token_path, SCOPES)
+        if not creds.has_scopes(SCOPES):
+            # Saved before CalendarMe asked for free/busy access
+            creds = None
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(lazy_import('google.auth.transport.requests').Request())
+        elif not interactive:
+            raise ValueError(f"No valid sign-in saved in {token_path}. Sign in again with --sign-in.")
+        else:
+            flow = lazy_import('google_auth_oauthlib.flow').InstalledAppFlow.from_client_secrets_file(
+                'credentials.json', SCOPES)
+            creds = flow.run_local_server(port=0)
+        save_credentials(creds, token_path)
+    return creds
+
+discovery_document = None
 
-import requests
-SCOPES = ['https://www.googleapis.com/auth/calendar.events']
+def get_discovery_document():
+    global discovery_document
+    if discovery_document is None:
+        if os.path.exists(DISCOVERY_CACHE_PATH):
+            with open(DISCOVERY_CACHE_PATH) as f:
+                discovery_document = json.load(f)
+        else:
+            service = lazy_import('googleapiclient.discovery').build(
+                'calendar', 'v3', http=lazy_import('httplib2').Http())
+            discovery_document = service._rootDesc
+            try:
+                with open(DISCOVERY_CACHE_PATH + '.tmp', 'w') as f:
+                    json.dump(discovery_document, f)
+                os.replace(DISCOVERY_CACHE_PATH + '.tmp', DISCOVERY_CACHE_PATH)
+            except OSError as e:
+                print(f"Could not cache the Calendar discovery document: {e}")
+    return discovery_document
+
+def build_calendar_service(http):
+    started = time.perf_counter()
+    service = lazy_import('googleapiclient.discovery').build_from_document(get_discovery_document(), http=http)
+    record_startup_phase("build calendar service", started)
+    return service
+
+TOKEN_REFRESH_MARGIN = 5 * 60
+HTTP_TIMEOUT = 30
+TOKEN_DIRECTORY = 'tokens'
+SESSION_POOL_SIZE = 16
+
+def token_path_for(user=None):
+    if user is None:
+        return 'token.json'
+    if not isinstance(user, str) or not re.fullmatch(r"[\w.@+-]+", user) or user.startswith('.'):
+        raise ValueError(f"Invalid user name {user}.")
+    return os.path.join(TOKEN_DIRECTORY, f"{user}.json")
+
+def sign_in(user):
+    token_path = token_path_for(user)
+    os.makedirs(os.path.dirname(token_path), exist_ok=True)
+    load_credentials(token_path)
+    print(f"Signed in {user}. Their sign-in is saved in {token_path}.")
+
+class CalendarSession:
+    def __init__(self, token_path='token.json', interactive=True):
+        self.token_path = token_path
+        self.interactive = interactive
+        self.creds = None
+        self.lock = threading.RLock()
+        self.local = threading.local()
+
+    def credentials(self):
+        with self.lock:
+            if self.creds is None:
+                started = time.perf_counter()
+                self.creds = load_credentials(self.token_path, self.interactive)
+                record_startup_phase("load credentials", started)
+            elif self.creds.refresh_token and self.creds.expiry and self.creds.expiry - datetime.datetime.now(
+                    datetime.timezone.utc).replace(tzinfo=None) < datetime.timedelta(seconds=TOKEN_REFRESH_MARGIN):
+                self.creds.refresh(lazy_import('google.auth.transport.requests').Request())
+                save_credentials(self.creds, self.token_path)
+            return self.creds
+
+    def http(self):
+        http = getattr(self.local, 'http', None)
+        if http is None:
+            http = ScheduledHttp(lazy_import('google_auth_httplib2').AuthorizedHttp(
+                self.credentials(), http=lazy_import('httplib2').Http(timeout=HTTP_TIMEOUT)))
+            self.local.http = http
+        return http
+
+    def service(self):
+        service = getattr(self.local, 'service', None)
+        if service is None:
+            service = build_calendar_service(self.http())
+            self.local.service = service
+        return service
+
+    def __getattr__(self, name):
+        self.credentials()
+        return getattr(self.service(), name)
+
+class SessionPool:
+    # Authorized sessions for the most recently active users, dropping the least recently used past the limit
+    def __init__(self, size=SESSION_POOL_SIZE):
+        self.size = size
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user=None):
+        with self.lock:
+            session = self.sessions.pop(user, None)
+            if session is None:
+                token_path = token_path_for(user)
+                if user is not None and not os.path.exists(token_path):
+                    raise ValueError(f"{user} hasn't signed in yet. Run CalendarMe with --sign-in {user} first.")
+                # Only the person at the console can be asked to sign in
+                session = CalendarSession(token_path, interactive=user is None)
+            self.sessions[user] = session
+            while len(self.sessions) > self.size:
+                self.sessions.popitem(last=False)
+            return session
 
 def readable_time(time, format):
     formatted_time = datetime.datetime.strptime(time, format)
@@ -59,41 +439,140 @@ def describe_weather(weathercode):
 
 
 
-def get_weather(date=None):
-    base_url = "https://api.open-meteo.com/v1/forecast"
+WEATHER_CACHE_PATH = 'weather_cache.json'
+WEATHER_CACHE_TTL = 3 * 60 * 60
+forecast_cache = None
+forecast_lock = threading.Lock()
+forecast_key_locks = {}
+
+def load_forecast_cache():
+    global forecast_cache
+    if forecast_cache is None:
+        forecast_cache = {}
+        if os.path.exists(WEATHER_CACHE_PATH):
+            try:
+                with open(WEATHER_CACHE_PATH) as f:
+                    forecast_cache = json.load(f)
+            except (OSError, ValueError):
+                print("Could not read the weather cache. Starting with an empty one.")
+    return forecast_cache
+
+def save_forecast_cache():
+    now = time.time()
+    for key in [key for key, entry in forecast_cache.items() if now - entry['fetched'] >= WEATHER_CACHE_TTL]:
+        del forecast_cache[key]
+    try:
+        with open(WEATHER_CACHE_PATH + '.tmp', 'w') as f:
+            json.dump(forecast_cache, f)
+        os.replace(WEATHER_CACHE_PATH + '.tmp', WEATHER_CACHE_PATH)
+    except OSError as e:
+        print(f"Could not save the weather cache: {e}")
+
+def fetch_json(url, params):
+    response = lazy_import('requests').get(url, params=params, headers={'User-Agent': 'CalendarMe'}, timeout=HTTP_TIMEOUT)
+    annotate_span(status=getattr(response, 'status_code', None), response_bytes=len(getattr(response, 'content', b'') or b''))
+    response.raise_for_status()
+    return response.json()
+
+def get_forecast(latitude, longitude, day):
+    key = f"{latitude:.4f},{longitude:.4f},{day}"
+    with forecast_lock:
+        cache = load_forecast_cache()
+        key_lock = forecast_key_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        with forecast_lock:
+            entry = cache.get(key)
+            if entry and time.time() - entry['fetched'] < WEATHER_CACHE_TTL:
+                annotate_span(cache_hit=True)
+                return entry['hours']
+        data = call_with_backoff('weather', fetch_json, "https://api.open-meteo.com/v1/forecast", {
+            'latitude': latitude,
+            'longitude': longitude,
+            'hourly': 'temperature_2m,weathercode',
+            'timezone': 'auto',
+            'start_date': day,
+            'end_date': day,
+        })
+        hourly = data['hourly']
+        hours = {hour: [weathercode, temperature] for hour, weathercode, temperature
+                 in zip(hourly['time'], hourly['weathercode'], hourly['temperature_2m'])}
+        with forecast_lock:
+            cache[key] = {'fetched': time.time(), 'hours': hours}
+            save_forecast_cache()
+        annotate_span(cache_hit=False)
+        return hours
+
+def get_weather(date=None, location=None):
+    with trace_span('weather', 'get_weather', location=location or city_name):
+        return weather_at(date, location)
+
+def weather_at(date=None, location=None):
     if date is None:
-        date = (datetime.now()).strftime("%Y-%m-%dT%H:00")
+        date = (datetime.datetime.now()).strftime("%Y-%m-%dT%H:00")
     else:
         date = date[:-5]+"00"
-    print(date)
-    complete_url = f"{base_url}?latitude={lat}&longitude={lon}&hourly=temperature_2m,weathercode&time={date}"
 
+    requests = lazy_import('requests')
     try:
-        response = requests.get(complete_url)
-        data = response.json()
-        weather_info = None
-        for i, time in enumerate(data['hourly']['time']):
-            if not time == date:
-                continue
-            print("Found it!")
-            weather_info = {
-                "description": describe_weather(data['hourly']["weathercode"][i]),
-                "temperature": data['hourly']["temperature_2m"][i],
-            }
-            break
-        return weather_info
-    except requests.exceptions.RequestException as e:
+        coordinates = get_coordinates(location)
+        if coordinates is None:
+            return None
+        hours = get_forecast(coordinates[0], coordinates[1], date[:10])
+    except (requests.exceptions.RequestException, KeyError, ValueError) as e:
         return f"Error: {e}"
+    if date not in hours:
+        return None
+    weathercode, temperature = hours[date]
+    return {
+        "description": describe_weather(weathercode),
+        "temperature": temperature,
+    }
 
 
 city_name = "Copenhagen"
 country_code = "Denmark"
+GEOCODE_CACHE_PATH = 'geocode_cache.json'
+geocode_cache = None
+geocode_lock = threading.Lock()
+
+def load_geocode_cache():
+    global geocode_cache
+    if geocode_cache is None:
+        geocode_cache = {}
+        if os.path.exists(GEOCODE_CACHE_PATH):
+            try:
+                with open(GEOCODE_CACHE_PATH) as f:
+                    geocode_cache = json.load(f)
+            except (OSError, ValueError):
+                print("Could not read the geocoding cache. Starting with an empty one.")
+    return geocode_cache
 
-complete_url = f"https://nominatim.openstreetmap.org/search?city={city_name}&country={country_code}&format=json"
-response = requests.get(complete_url)
-data = response.json()
-lat = float(data[0]["lat"])
-lon = float(data[0]["lon"])
+def save_geocode_cache():
+    try:
+        with open(GEOCODE_CACHE_PATH + '.tmp', 'w') as f:
+            json.dump(geocode_cache, f)
+        os.replace(GEOCODE_CACHE_PATH + '.tmp', GEOCODE_CACHE_PATH)
+    except OSError as e:
+        print(f"Could not save the geocoding cache: {e}")
+
+def get_coordinates(location=None):
+    if location:
+        key = location.strip().lower()
+        params = {'q': location, 'format': 'json', 'limit': 1}
+    else:
+        key = f"{city_name}, {country_code}".lower()
+        params = {'city': city_name, 'country': country_code, 'format': 'json', 'limit': 1}
+    with geocode_lock:
+        cache = load_geocode_cache()
+        if key not in cache:
+            data = call_with_backoff('geocode', fetch_json, "https://nominatim.openstreetmap.org/search", params)
+            cache[key] = [float(data[0]["lat"]), float(data[0]["lon"])] if data else None
+            save_geocode_cache()
+        coordinates = cache[key]
+    if coordinates is None and location:
+        print(f"Could not find '{location}'. Using {city_name} instead.")
+        return get_coordinates()
+    return tuple(coordinates) if coordinates else None
 
 class ScryException(BaseException):
     pass
@@ -111,74 +590,661 @@ class GetEventsBetweenTimesException(BaseException):
         self.start_time = start_time
         self.end_time = end_time
 
+console_lock = threading.RLock()
+command_state = threading.local()
+
+class ThreadOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.last_label = None
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stream.write(text)
+        buffer.append(text)
+        return len(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def start_buffering(self, label):
+        self.local.buffer = []
+        self.local.label = label
+
+    def release(self):
+        buffer = getattr(self.local, 'buffer', None)
+        if not buffer:
+            return
+        with console_lock:
+            if self.last_label != self.local.label:
+                self.stream.write(f"\n----- {self.local.label} -----\n")
+                self.last_label = self.local.label
+            self.stream.write("".join(buffer))
+            self.stream.flush()
+        self.local.buffer = []
+
+    def stop_buffering(self):
+        self.release()
+        self.local.buffer = None
+
+    def take(self):
+        text = "".join(getattr(self.local, 'buffer', None) or [])
+        self.local.buffer = None
+        return text
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def thread_output():
+    if not isinstance(sys.stdout, ThreadOutput):
+        sys.stdout = ThreadOutput(sys.stdout)
+    return sys.stdout
+
+class ApprovalPolicy:
+    # Answers the questions a command would otherwise ask at the console
+    def __init__(self, approve='default', answers=None):
+        if approve not in ['all', 'none', 'default']:
+            raise ValueError("approve must be 'all', 'none' or 'default'")
+        if not isinstance(answers or {}, dict):
+            raise ValueError("answers must map questions to answers")
+        self.approve = approve
+        self.answers = answers or {}
+        self.asked = []
+
+    def answer(self, prompt):
+        reply = ""
+        for question, answer in self.answers.items():
+            if prompt.startswith(question):
+                reply = answer
+                break
+        else:
+            if prompt.startswith("Confirm changes?") and self.approve != 'default':
+                reply = 'yes' if self.approve == 'all' else 'no'
+        self.asked.append([prompt, reply])
+        return reply
+
+def console_input(prompt):
+    policy = getattr(command_state, 'policy', None)
+    if policy is not None:
+        return policy.answer(prompt)
+    with console_lock:
+        if isinstance(sys.stdout, ThreadOutput):
+            sys.stdout.release()
+            sys.stdout.last_label = getattr(sys.stdout.local, 'label', None)
+        return input(prompt)
+
+default_calendar_id = 'primary'
+default_timezone = 'Europe/Copenhagen'
+busy_calendars = []
+free_busy_only = False
+
+def active_user():
+    return getattr(command_state, 'user', None)
+
+def active_calendar():
+    return getattr(command_state, 'calendar_id', None) or default_calendar_id
+
+def active_timezone():
+    return getattr(command_state, 'timezone', None) or default_timezone
+
+def active_busy_calendars():
+    return getattr(command_state, 'busy_calendars', None) or busy_calendars
+
+def tenant_state():
+    return (active_user(), getattr(command_state, 'calendar_id', None), getattr(command_state, 'timezone', None),
+            getattr(command_state, 'busy_calendars', None))
+
+@contextlib.contextmanager
+def acting_for(user=None, calendar_id=None, timezone=None, busy_calendar_ids=None):
+    previous = tenant_state()
+    command_state.user, command_state.calendar_id, command_state.timezone, command_state.busy_calendars = (
+        user, calendar_id, timezone, busy_calendar_ids)
+    try:
+        yield
+    finally:
+        command_state.user, command_state.calendar_id, command_state.timezone, command_state.busy_calendars = previous
+
+def with_tenant(function):
+    # Worker threads start without command_state, so carry the caller's user, calendar and timezone over
+    state = tenant_state()
+    def run(*args, **kwargs):
+        with acting_for(*state):
+            return function(*args, **kwargs)
+    return run
+
 def get_now():
-    timezone = pytz.timezone('Etc/GMT-2')
+    timezone = lazy_import('pytz').timezone(active_timezone())
     now = datetime.datetime.now(timezone)
     return now
 
-def delete_events(service, event_ids):
-    for event_id in event_ids:
-        event = service.events().get(calendarId='primary', eventId=event_id).execute()
-        service.events().delete(calendarId='primary', eventId=event_id).execute()
-        print(f"Event named '{event['summary']}' deleted successfully.")
-
+STORE_PATH = 'calendarMe.db'
+STORE_SYNC_INTERVAL = 30
+STORE_PAGE_SIZE = 100
+EVENT_FIELDS = "id,etag,status,summary,description,location,start,end,reminders"
+store_connection = None
+store_lock = threading.RLock()
+last_store_sync = {}
+store_sync_locks = {}
+store_sync_locks_lock = threading.Lock()
+
+def get_store():
+    global store_connection
+    with store_lock:
+        if store_connection is None:
+            store_connection = sqlite3.connect(STORE_PATH, check_same_thread=False)
+            store_connection.execute(
+                "CREATE TABLE IF NOT EXISTS events (calendar_id TEXT, id TEXT, start_ts REAL, end_ts REAL, data TEXT, PRIMARY KEY (calendar_id, id))")
+            store_connection.execute(
+                "CREATE INDEX IF NOT EXISTS events_by_time ON events (calendar_id, start_ts, end_ts)")
+            store_connection.execute(
+                "CREATE TABLE IF NOT EXISTS sync_state (calendar_id TEXT PRIMARY KEY, sync_token TEXT)")
+            store_connection.execute(
+                "CREATE TABLE IF NOT EXISTS llm_responses (key TEXT PRIMARY KEY, response TEXT, created REAL)")
+            store_connection.execute(
+                "CREATE TABLE IF NOT EXISTS pending_writes (key TEXT PRIMARY KEY, action TEXT, event_id TEXT, body TEXT, etag TEXT, attempts INTEGER DEFAULT 0, created REAL, "
+                "user TEXT DEFAULT '', calendar_id TEXT DEFAULT 'primary', claimed INTEGER DEFAULT 0)")
+            columns = [row[1] for row in store_connection.execute("PRAGMA table_info(pending_writes)")]
+            if 'user' not in columns:
+                # Queues written before CalendarMe served several users all belong to the console user's primary calendar
+                store_connection.execute("ALTER TABLE pending_writes ADD COLUMN user TEXT DEFAULT ''")
+                store_connection.execute("ALTER TABLE pending_writes ADD COLUMN calendar_id TEXT DEFAULT 'primary'")
+            if 'claimed' not in columns:
+                store_connection.execute("ALTER TABLE pending_writes ADD COLUMN claimed INTEGER DEFAULT 0")
+            # Whoever claimed a write in an earlier run is gone, so the background flusher sends it
+            store_connection.execute("UPDATE pending_writes SET claimed=0")
+            store_connection.commit()
+        return store_connection
+
+def event_datetime(event_time):
+    if 'dateTime' not in event_time:
+        return parse_date_time(event_time['date'])
+    moment = lazy_import('dateutil.parser').isoparse(event_time['dateTime'])
+    if moment.tzinfo is None:
+        moment = lazy_import('pytz').timezone(event_time.get('timeZone') or active_timezone()).localize(moment)
+    return moment
+
+def event_timestamp(event_time):
+    return event_datetime(event_time).timestamp()
+
+def store_key(calendar_id=None):
+    # Every user has their own 'primary', so the local copy is kept per user and calendar
+    calendar_id = calendar_id or active_calendar()
+    return f"{active_user()}/{calendar_id}" if active_user() else calendar_id
+
+def store_events(events, calendar_id=None):
+    calendar_id = store_key(calendar_id)
+    with store_lock:
+        store = get_store()
+        for event in events:
+            if event.get('status') == 'cancelled':
+                store.execute("DELETE FROM events WHERE calendar_id=? AND id=?", (calendar_id, event['id']))
+                continue
+            store.execute("INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?)", (
+                calendar_id, event['id'], event_timestamp(event['start']),
+                event_timestamp(event['end']), json.dumps(event)))
+        store.commit()
+
+def forget_events(event_ids, calendar_id=None):
+    calendar_id = store_key(calendar_id)
+    with store_lock:
+        store = get_store()
+        store.executemany("DELETE FROM events WHERE calendar_id=? AND id=?",
+                          [(calendar_id, event_id) for event_id in event_ids])
+        store.commit()
+
+def store_sync_lock(key):
+    with store_sync_locks_lock:
+        return store_sync_locks.setdefault(key, threading.Lock())
+
+def sync_local_store(service, calendar_id=None, force=False):
+    calendar_id = calendar_id or active_calendar()
+    key = store_key(calendar_id)
+    # One sync per calendar at a time, and store_lock only around the SQLite work so reads aren't held up by the network
+    with store_sync_lock(key):
+        if not force and time.time() - last_store_sync.get(key, 0) < STORE_SYNC_INTERVAL:
+            return
+        with store_lock:
+            row = get_store().execute("SELECT sync_token FROM sync_state WHERE calendar_id=?", (key,)).fetchone()
+        sync_token = row[0] if row else None
+        page_token = None
+        expired = False
+        events = []
+        while True:
+            try:
+                events_result = service.events().list(
+                    calendarId=calendar_id, singleEvents=True, maxResults=250,
+                    syncToken=sync_token, pageToken=page_token,
+                    fields=f"nextPageToken,nextSyncToken,items({EVENT_FIELDS})").execute()
+            except http_error() as error:
+                if error.resp.status != 410 or sync_token is None:
+                    raise
+                print("Local calendar copy expired. Downloading the calendar again...")
+                expired = True
+                events = []
+                sync_token = None
+                page_token = None
+                continue
+            events.extend(events_result.get('items', []))
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                break
+        with store_lock:
+            store = get_store()
+            if expired:
+                store.execute("DELETE FROM events WHERE calendar_id=?", (key,))
+            store_events(events, calendar_id)
+            store.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?)",
+                          (key, events_result.get('nextSyncToken')))
+            store.commit()
+        last_store_sync[key] = time.time()
+        if events:
+            print(f"Synced {len(events)} changed event(s) to the local calendar copy.")
+
+def stored_events_between(start_time, end_time, calendar_id=None):
+    # Read the window a page at a time so callers can stop early and big windows stay cheap
+    calendar_id = store_key(calendar_id)
+    start_ts = lazy_import('dateutil.parser').isoparse(start_time).timestamp()
+    end_ts = lazy_import('dateutil.parser').isoparse(end_time).timestamp()
+    after = (float('-inf'), '')
+    while True:
+        with store_lock:
+            rows = get_store().execute(
+                "SELECT start_ts, id, data FROM events WHERE calendar_id=? AND end_ts > ? AND start_ts < ? "
+                "AND (start_ts > ? OR (start_ts = ? AND id > ?)) ORDER BY start_ts, id LIMIT ?",
+                (calendar_id, start_ts, end_ts, after[0], after[0], after[1], STORE_PAGE_SIZE)).fetchall()
+        for row in rows:
+            yield json.loads(row[2])
+        if len(rows) < STORE_PAGE_SIZE:
+            return
+        after = (rows[-1][0], rows[-1][1])
+
+def stored_events_after(start_time, amount, calendar_id=None):
+    calendar_id = store_key(calendar_id)
+    with store_lock:
+        rows = get_store().execute(
+            "SELECT data FROM events WHERE calendar_id=? AND end_ts > ? ORDER BY start_ts LIMIT ?",
+            (calendar_id, lazy_import('dateutil.parser').isoparse(start_time).timestamp(), amount)).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+MIN_FREE_SLOT_MINUTES = 15
+
+def time_to_timestamp(time_string):
+    if len(time_string) == len("YYYY-MM-DD"):
+        return parse_date_time(time_string).timestamp()
+    return lazy_import('dateutil.parser').isoparse(time_string).timestamp()
+
+def timestamp_to_time(timestamp, format="%Y-%m-%d %H:%M"):
+    return datetime.datetime.fromtimestamp(timestamp, lazy_import('pytz').timezone(active_timezone())).strftime(format)
+
+class EventIndex:
+    def __init__(self, events):
+        self.events = sorted(events, key=lambda event: (time_to_timestamp(event['start']), time_to_timestamp(event['end'])))
+        self.starts = [time_to_timestamp(event['start']) for event in self.events]
+        self.ends = [time_to_timestamp(event['end']) for event in self.events]
+        self.max_ends = [0] * len(self.events)
+        self.build(0, len(self.events))
+
+    def build(self, low, high):
+        if low >= high:
+            return float('-inf')
+        middle = (low + high) // 2
+        self.max_ends[middle] = max(self.ends[middle], self.build(low, middle), self.build(middle + 1, high))
+        return self.max_ends[middle]
+
+    def overlapping(self, start, end):
+        found = []
+        self.collect(0, len(self.events), start, end, found)
+        return found
+
+    def collect(self, low, high, start, end, found):
+        if low >= high or self.max_ends[(low + high) // 2] <= start:
+            return
+        middle = (low + high) // 2
+        self.collect(low, middle, start, end, found)
+        if self.starts[middle] < end:
+            if self.ends[middle] > start:
+                found.append(middle)
+            self.collect(middle + 1, high, start, end, found)
+
+    def events_overlapping(self, start, end):
+        return [self.events[i] for i in self.overlapping(start, end)]
+
+    def next_after(self, start, amount=1):
+        first = bisect.bisect_left(self.starts, start)
+        return self.events[first:first + amount]
+
+    def free_slots(self, start, end, min_minutes=MIN_FREE_SLOT_MINUTES):
+        slots = []
+        free_from = start
+        for i in self.overlapping(start, end):
+            if self.starts[i] - free_from >= min_minutes * 60:
+                slots.append((free_from, self.starts[i]))
+            free_from = max(free_from, self.ends[i])
+        if end - free_from >= min_minutes * 60:
+            slots.append((free_from, end))
+        return slots
+
+BATCH_LIMIT = 50
+
+def execute_batch(service, requests_by_id, max_retries=2):
+    responses = {}
+    errors = {}
+    pending = dict(requests_by_id)
+    attempt = 0
+    while pending:
+        failed = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                responses[request_id] = response
+                errors.pop(request_id, None)
+            else:
+                errors[request_id] = exception
+                failed.append(request_id)
+
+        request_ids = list(pending)
+        for i in range(0, len(request_ids), BATCH_LIMIT):
+            batch = service.new_batch_http_request(callback=callback)
+            chunk = request_ids[i:i + BATCH_LIMIT]
+            for request_id in chunk:
+                batch.add(pending[request_id], request_id=request_id)
+            try:
+                batch.execute()
+            except Exception as e:
+                for request_id in chunk:
+                    if request_id not in responses and request_id not in failed:
+                        errors[request_id] = e
+                        failed.append(request_id)
+
+        retryable = [request_id for request_id in failed if classify_error(errors[request_id])[0]]
+        if not retryable or attempt >= max_retries:
+            break
+        attempt = attempt + 1
+        print(f"{len(retryable)} request(s) failed. Retrying ({attempt}/{max_retries})...")
+        time.sleep(max([classify_error(errors[request_id])[1] or 0 for request_id in retryable] + [backoff_delay(attempt)]))
+        pending = {request_id: pending[request_id] for request_id in retryable}
+    return responses, errors
+
+def get_events_by_ids(service, event_ids):
+    requests_by_id = {str(i): service.events().get(calendarId=active_calendar(), eventId=event_id, fields=EVENT_FIELDS)
+                      for i, event_id in enumerate(event_ids)}
+    responses, errors = execute_batch(service, requests_by_id)
+    events = {}
+    for i, event_id in enumerate(event_ids):
+        if str(i) in responses:
+            events[event_id] = responses[str(i)]
+        else:
+            print(f"Could not fetch event {event_id}: {errors.get(str(i))}")
+    return events
 
-def update_events(service, event_ids, revised_events):
-    yes_to_all = False
-    for event_id, revised_event in zip(event_ids, revised_events):
-        event = service.events().get(calendarId='primary', eventId=event_id).execute()
-        changes = []
-        if revised_event['summary'] and event['summary'] != revised_event['summary']:
-            changes.append(
-                f"Summary: {event['summary']} -> {revised_event['summary']}\n")
-        if revised_event['description'] and event['description'] != revised_event['description']:
-            changes.append(
-                f"Description: {event['description']} -> {revised_event['description']}\n")
-        if revised_event['start'] and event['start']['dateTime'] != revised_event['start']:
-            readable_old_time = readable_time(event['start']['dateTime'],"%Y-%m-%dT%H:%M:%S")
-            readable_new_time = readable_time(
-                revised_event['start'], "%Y-%m-%dT%H:%M:%S")
-            changes.append(f"Start time: {readable_old_time} -> {readable_new_time}\n")
-        if revised_event['end'] and event['end']['dateTime'] != revised_event['end']:
-            readable_old_time = readable_time(event['end']['dateTime'],"%Y-%m-%dT%H:%M:%S")
-            readable_new_time = readable_time(
-                revised_event['end'], "%Y-%m-%dT%H:%M:%S")
-            changes.append(
-                f"End time: {readable_old_time} -> {readable_new_time}\n")
-        if revised_event['reminders'] and event['reminders'] != revised_event['reminders']:
-            changes.append(
-                f"Reminders: {event['reminders']} -> {revised_event['reminders']}\n")
-        if changes:
-            if not yes_to_all:
-                print()
-                print(f"These changes are about to be made to \"{event['summary']}\":\n     - " +
-                        "     - ".join(changes))
-                confirm = get_input("Confirm changes?", "yes")
-                if confirm.lower() in ["no", "n"]:
-                    continue
-                if confirm.lower() in ["yy", "yes to all"]:
-                    if get_input("This will approve all edits, even ones you've disapprove. Write \"yes\" to affirm.") == "yes":
-                        yes_to_all = True
-                if confirm.lower() in ["nn", "no to all"]:
-                    if get_input("This will disapprove all edits, even ones you've approved. Write \"yes\" to affirm.") == "yes":
-                        return
+FREEBUSY_CALENDAR_LIMIT = 50
+
+def get_busy_times(service, calendar_ids, start_time, end_time):
+    # Just the busy intervals, which is all free time needs and all a teammate's calendar may share
+    busy = {}
+    for i in range(0, len(calendar_ids), FREEBUSY_CALENDAR_LIMIT):
+        result = service.freebusy().query(body={
+            'timeMin': start_time,
+            'timeMax': end_time,
+            'timeZone': active_timezone(),
+            'items': [{'id': calendar_id} for calendar_id in calendar_ids[i:i + FREEBUSY_CALENDAR_LIMIT]],
+        }, fields='calendars').execute()
+        for calendar_id, calendar in result.get('calendars', {}).items():
+            for error in calendar.get('errors', []):
+                print(f"Could not see when {calendar_id} is busy: {error.get('reason')}")
+            busy[calendar_id] = [{'start': period['start'], 'end': period['end']} for period in calendar.get('busy', [])]
+    return busy
+
+def error_status(error):
+    return getattr(getattr(error, 'resp', None), 'status', None)
+
+def precondition_failed(error):
+    return error_status(error) == 412
+
+WRITE_FLUSH_INTERVAL = 30
+WRITE_FLUSH_LIMIT = 500
+WRITE_FIELDS = EVENT_FIELDS + ",htmlLink"
+write_flush_wakeup = threading.Event()
+write_flusher = None
+write_flusher_services = {}
+
+def queue_writes(action, writes, claim=True):
+    # Writes are logged before they are sent, so a crash or outage can't lose them.
+    # Inserts get their event id here, which makes replaying them idempotent.
+    # Claimed writes are left to the caller's own flush, the background flusher skips them.
+    rows = []
+    for event_id, body, etag in writes:
+        if action == 'insert':
+            body = dict(body, id=body.get('id') or uuid.uuid4().hex)
+            event_id = body['id']
+        rows.append((uuid.uuid4().hex, action, event_id, json.dumps(body) if body is not None else None, etag, time.time(),
+                     active_user() or '', active_calendar(), int(claim)))
+    # Windows read ahead of time won't show these writes
+    forget_prefetches()
+    with store_lock:
+        store = get_store()
+        store.executemany("INSERT INTO pending_writes (key, action, event_id, body, etag, created, user, calendar_id, claimed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        store.commit()
+    return [row[0] for row in rows]
+
+def pending_write_count():
+    with store_lock:
+        return get_store().execute("SELECT COUNT(*) FROM pending_writes").fetchone()[0]
+
+def pending_write_users():
+    with store_lock:
+        return [row[0] for row in get_store().execute("SELECT DISTINCT user FROM pending_writes").fetchall()]
+
+def flush_write_queue(service, keys=None):
+    # Returns {key: (outcome, detail)} with outcome done, conflict, failed or pending.
+    # Without keys, sends the oldest unclaimed queued writes of the user service is signed in as.
+    # Rows are claimed while they're sent, so nothing else sends them and no lock is held over the network.
+    with store_lock:
+        store = get_store()
+        if keys is None:
+            rows = store.execute(
+                "SELECT key, action, event_id, body, etag, calendar_id FROM pending_writes WHERE user=? AND claimed=0 ORDER BY rowid LIMIT ?",
+                (active_user() or '', WRITE_FLUSH_LIMIT)).fetchall()
+            store.executemany("UPDATE pending_writes SET claimed=1 WHERE key=?", [(row[0],) for row in rows])
+            store.commit()
         else:
-            print("No changes to be made for event '",event['summary'],"'")
-            continue
+            rows = store.execute(
+                f"SELECT key, action, event_id, body, etag, calendar_id FROM pending_writes WHERE key IN ({','.join('?' * len(keys))}) ORDER BY rowid",
+                list(keys)).fetchall() if keys else []
+    try:
+        results = send_queued_writes(service, rows)
+    finally:
+        if rows:
+            # Whatever is still queued is now the background flusher's to retry
+            with store_lock:
+                store = get_store()
+                store.executemany("UPDATE pending_writes SET claimed=0 WHERE key=?", [(row[0],) for row in rows])
+                store.commit()
+    for key in keys or []:
+        # A write that is no longer queued was sent elsewhere, and its outcome isn't known here
+        results.setdefault(key, ('pending', None))
+    if any(outcome == 'pending' for outcome, detail in results.values()):
+        start_write_flusher(service, wake=False)
+    return results
+
+def send_queued_writes(service, rows):
+    results = {}
+    if not rows:
+        return results
+    requests_by_id = {}
+    for key, action, event_id, body, etag, calendar_id in rows:
+        if action == 'insert':
+            request = service.events().insert(calendarId=calendar_id, body=json.loads(body), fields=WRITE_FIELDS)
+        elif action == 'patch':
+            request = service.events().patch(calendarId=calendar_id, eventId=event_id, body=json.loads(body), fields=WRITE_FIELDS)
+        else:
+            request = service.events().delete(calendarId=calendar_id, eventId=event_id)
+        if etag:
+            # Only write if the event is still the version we showed the user
+            request.headers['If-Match'] = etag
+        requests_by_id[key] = request
+    responses, errors = execute_batch(service, requests_by_id)
+
+    written = {}
+    deleted = {}
+    conflicted = set()
+    for key, action, event_id, body, etag, calendar_id in rows:
+        error = errors.get(key)
+        if key in responses or (action == 'insert' and error_status(error) == 409) or (action == 'delete' and error_status(error) in (404, 410)):
+            # An insert that conflicts already happened, and a missing event is already deleted
+            if action == 'delete':
+                deleted.setdefault(calendar_id, []).append(event_id)
+                results[key] = ('done', None)
+            else:
+                response = responses.get(key) or json.loads(body)
+                written.setdefault(calendar_id, []).append(response)
+                results[key] = ('done', response)
+        elif precondition_failed(error):
+            results[key] = ('conflict', error)
+            conflicted.add(calendar_id)
+        elif classify_error(error)[0]:
+            results[key] = ('pending', error)
+        else:
+            results[key] = ('failed', error)
+    for calendar_id, events in written.items():
+        store_events(events, calendar_id)
+    for calendar_id, event_ids in deleted.items():
+        forget_events(event_ids, calendar_id)
+    with store_lock:
+        store = get_store()
+        store.executemany("DELETE FROM pending_writes WHERE key=?",
+                          [(key,) for key, (outcome, detail) in results.items() if outcome != 'pending'])
+        store.executemany("UPDATE pending_writes SET attempts=attempts+1 WHERE key=?",
+                          [(key,) for key, (outcome, detail) in results.items() if outcome == 'pending'])
+        store.commit()
+    for calendar_id in conflicted:
+        sync_local_store(service, calendar_id, force=True)
+    return results
+
+def write_flusher_loop():
+    while True:
+        write_flush_wakeup.wait(WRITE_FLUSH_INTERVAL)
+        write_flush_wakeup.clear()
+        for user, service in list(write_flusher_services.items()):
+            try:
+                if not pending_write_count():
+                    break
+                with acting_for(user or None):
+                    results = flush_write_queue(service)
+            except Exception as e:
+                with console_lock:
+                    print(f"\nCould not send queued calendar changes{' for ' + user if user else ''}: {e}")
+                continue
+            sent = sum(1 for outcome, detail in results.values() if outcome == 'done')
+            if sent:
+                with console_lock:
+                    print(f"\nSent {sent} queued calendar change(s) to Google Calendar.")
+
+def start_write_flusher(service, wake=True):
+    global write_flusher
+    # Each user's queued writes are sent with their own session
+    write_flusher_services[active_user() or ''] = service
+    if write_flusher is None:
+        write_flusher = threading.Thread(target=write_flusher_loop, daemon=True)
+        write_flusher.start()
+    if wake:
+        write_flush_wakeup.set()
+
+def delete_events(service, event_ids, context=None):
+    events = context.get_events(event_ids) if context else get_events_by_ids(service, event_ids)
+    event_ids = [event_id for event_id in event_ids if event_id in events]
+    keys = queue_writes('delete', [(event_id, None, events[event_id].get('etag')) for event_id in event_ids])
+    results = flush_write_queue(service, keys)
+    if context:
+        context.forget([event_id for key, event_id in zip(keys, event_ids) if results[key][0] == 'done'])
+    for key, event_id in zip(keys, event_ids):
+        summary = events[event_id]['summary']
+        outcome, detail = results[key]
+        if outcome == 'done':
+            print(f"Event named '{summary}' deleted successfully.")
+        elif outcome == 'conflict':
+            print(f"Event named '{summary}' was changed elsewhere since it was fetched, so it was not deleted.")
+        elif outcome == 'pending':
+            print(f"Event named '{summary}' will be deleted when Google Calendar is reachable.")
+        else:
+            print(f"Event named '{summary}' could not be deleted: {detail}")
 
-        event['summary'] = revised_event['summary']
-        event['description'] = revised_event['description']
-        event['start']['dateTime'] = revised_event['start']
-        event['end']['dateTime'] = revised_event['end']
-        event['reminders'] = revised_event['reminders']
 
-        updated_event = service.events().update(
-            calendarId='primary',
-            eventId=event_id,
-            body=event
-        ).execute()
+def update_events(service, event_ids, revised_events, context=None):
+    yes_to_all = False
+    events = context.get_events(event_ids) if context else get_events_by_ids(service, event_ids)
+    updates = []
+    with console_lock:
+        for event_id, revised_event in zip(event_ids, revised_events):
+            if event_id not in events:
+                continue
+            event = copy.deepcopy(events[event_id])
+            changes = []
+            if revised_event['summary'] and event['summary'] != revised_event['summary']:
+                changes.append(
+                    f"Summary: {event['summary']} -> {revised_event['summary']}\n")
+            if revised_event['description'] and event['description'] != revised_event['description']:
+                changes.append(
+                    f"Description: {event['description']} -> {revised_event['description']}\n")
+            if revised_event['start'] and event['start']['dateTime'] != revised_event['start']:
+                readable_old_time = readable_time(event['start']['dateTime'],"%Y-%m-%dT%H:%M:%S")
+                readable_new_time = readable_time(
+                    revised_event['start'], "%Y-%m-%dT%H:%M:%S")
+                changes.append(f"Start time: {readable_old_time} -> {readable_new_time}\n")
+            if revised_event['end'] and event['end']['dateTime'] != revised_event['end']:
+                readable_old_time = readable_time(event['end']['dateTime'],"%Y-%m-%dT%H:%M:%S")
+                readable_new_time = readable_time(
+                    revised_event['end'], "%Y-%m-%dT%H:%M:%S")
+                changes.append(
+                    f"End time: {readable_old_time} -> {readable_new_time}\n")
+            if revised_event['reminders'] and compact_reminders(event['reminders']) != compact_reminders(revised_event['reminders']):
+                changes.append(
+                    f"Reminders: {compact_reminders(event['reminders'])} -> {compact_reminders(revised_event['reminders'])}\n")
+            if changes:
+                if not yes_to_all:
+                    print()
+                    print(f"These changes are about to be made to \"{event['summary']}\":\n     - " +
+                            "     - ".join(changes))
+                    confirm = get_input("Confirm changes?", "yes")
+                    if confirm.lower() in ["no", "n"]:
+                        continue
+                    if confirm.lower() in ["yy", "yes to all"]:
+                        if get_input("This will approve all edits, even ones you've disapprove. Write \"yes\" to affirm.") == "yes":
+                            yes_to_all = True
+                    if confirm.lower() in ["nn", "no to all"]:
+                        if get_input("This will disapprove all edits, even ones you've approved. Write \"yes\" to affirm.") == "yes":
+                            return
+            else:
+                print("No changes to be made for event '",event['summary'],"'")
+                continue
 
-        print(f"Event '{updated_event['summary']}' updated successfully.")
+            event['summary'] = revised_event['summary']
+            event['description'] = revised_event['description']
+            event['start']['dateTime'] = revised_event['start']
+            event['end']['dateTime'] = revised_event['end']
+            event['reminders'] = revised_event['reminders']
+
+            updates.append((event_id, event))
+
+    # Patch only the edited fields, since stored copies hold just EVENT_FIELDS
+    keys = queue_writes('patch', [(event_id, {key: event[key] for key in ['summary', 'description', 'start', 'end', 'reminders']}, event.get('etag'))
+                                  for event_id, event in updates])
+    results = flush_write_queue(service, keys)
+    if context:
+        context.remember([results[key][1] for key in keys if results[key][0] == 'done'])
+    for key, (event_id, event) in zip(keys, updates):
+        outcome, detail = results[key]
+        if outcome == 'done':
+            print(f"Event '{detail['summary']}' updated successfully.")
+        elif outcome == 'conflict':
+            print(f"Event '{events[event_id]['summary']}' was changed elsewhere since it was fetched, so the edit was not applied.")
+        elif outcome == 'pending':
+            print(f"Event '{event['summary']}' will be updated when Google Calendar is reachable.")
+        else:
+            print(f"Event '{event['summary']}' could not be updated: {detail}")
     print()
 
 def get_events_between_times(service, start_time=None, end_time=None):
@@ -187,46 +1253,126 @@ def get_events_between_times(service, start_time=None, end_time=None):
     if end_time is None:
         end_time = get_now().replace(hour=23, minute=59, second=59).isoformat()
     
-    events_result = service.events().list(
-        calendarId="primary", timeMin=start_time, timeMax=end_time).execute()
-    events = events_result.get("items", [])
+    events = [summarize_event(event) for event in fetch_window_events(service, start_time, end_time)]
+    return events or None
 
-    event_list = []
-    print()
+PREFETCH_TTL = STORE_SYNC_INTERVAL
+WEATHER_PREFETCH_DAYS = 3
+window_prefetches = OrderedDict()
+window_prefetch_lock = threading.Lock()
 
-    if not events:
+def prefetch_window(service, start_time, end_time, weather=False):
+    # Speculative: the window may still change, so this only warms a short-lived cache
+    if service is None:
+        return
+    try:
+        start_time = parse_date_time(start_time).replace(second=0).isoformat()
+        end_time = parse_date_time(end_time).replace(second=0).isoformat()
+    except (ValueError, OverflowError):
+        return
+    key = (store_key(), time_to_timestamp(start_time), time_to_timestamp(end_time))
+    with window_prefetch_lock:
+        forget_expired_prefetches()
+        if key not in window_prefetches:
+            window_prefetches[key] = (time.time(), run_in_background(read_window, service, start_time, end_time, weather))
+
+def read_window(service, start_time, end_time, weather):
+    output = thread_output()
+    output.start_buffering("prefetch")
+    try:
+        if weather:
+            today = get_now().date()
+            day = max(datetime.date.fromisoformat(start_time[:10]), today)
+            while day <= datetime.date.fromisoformat(end_time[:10]) and (day - today).days < WEATHER_PREFETCH_DAYS:
+                get_weather(f"{day.isoformat()}T12:00:00")
+                day = day + datetime.timedelta(days=1)
+        sync_local_store(service)
+        return list(stored_events_between(start_time, end_time))
+    finally:
+        output.take()
+
+def forget_expired_prefetches():
+    while window_prefetches and time.time() - next(iter(window_prefetches.values()))[0] >= PREFETCH_TTL:
+        window_prefetches.popitem(last=False)
+
+def forget_prefetches():
+    with window_prefetch_lock:
+        window_prefetches.clear()
+
+def prefetched_window(start_time, end_time):
+    start_ts, end_ts = time_to_timestamp(start_time), time_to_timestamp(end_time)
+    with window_prefetch_lock:
+        forget_expired_prefetches()
+        futures = [future for (key, prefetch_start, prefetch_end), (started, future) in window_prefetches.items()
+                   if key == store_key() and prefetch_start <= start_ts and prefetch_end >= end_ts]
+    for future in futures:
+        try:
+            events = future.result()
+        except Exception:
+            continue
+        return [event for event in events if event_timestamp(event['end']) > start_ts and event_timestamp(event['start']) < end_ts]
+    return None
+
+def fetch_window_events(service, start_time, end_time):
+    events = prefetched_window(start_time, end_time)
+    if events is None:
+        sync_local_store(service)
+        events = stored_events_between(start_time, end_time)
+    print()
+    found = False
+    for event in events:
+        if not found:
+            print("Found events:")
+            found = True
+        print(event["start"].get("dateTime", event["start"].get("date")), event.get("summary", ""))
+        yield event
+    if not found:
         print("No events found.")
-        return None
-    else:
-        print("Found events:")
+
+def summarize_event(event):
+    return {
+        "id": event["id"],
+        "start": event["start"].get("dateTime", event["start"].get("date")),
+        "end": event["end"].get("dateTime", event["end"].get("date")),
+        "summary": event.get("summary", ""),
+        "description": event.get("description", ""),
+        "reminders": event.get("reminders", {})
+    }
+
+class EventContext:
+    # The window a command works on, fetched once and reused for confirmation and writes
+    def __init__(self, service, start_time=None, end_time=None):
+        self.service = service
+        if start_time is None:
+            start_time = get_now().isoformat()
+        if end_time is None:
+            end_time = get_now().replace(hour=23, minute=59, second=59).isoformat()
+        self.events = OrderedDict((event['id'], event) for event in fetch_window_events(service, start_time, end_time))
+
+    def summaries(self):
+        return [summarize_event(event) for event in self.events.values()]
+
+    def get_events(self, event_ids):
+        missing = [event_id for event_id in event_ids if event_id not in self.events]
+        if missing:
+            self.events.update(get_events_by_ids(self.service, missing))
+        return {event_id: self.events[event_id] for event_id in event_ids if event_id in self.events}
+
+    def remember(self, events):
         for event in events:
-            event_id = event["id"]
-            start = event["start"].get("dateTime", event["start"].get("date"))
-            end = event["end"].get("dateTime", event["end"].get("date"))
-            summary = event["summary"]
-            description = event.get("description", "")
-            reminders = event.get("reminders", {})
-            print(start, summary)
-            event_list.append({
-                "id": event_id,
-                "start": start,
-                "end": end,
-                "summary": summary,
-                "description": description,
-                "reminders": reminders
-            })
-    json_output = json.dumps(event_list)
-    return json_output
+            self.events[event['id']] = event
+
+    def forget(self, event_ids):
+        for event_id in event_ids:
+            self.events.pop(event_id, None)
 
 def get_next_event(service,amount=1):
     if amount <= 0:
         return None
     now = get_now().isoformat()
     print(f'Getting the upcoming {amount} events')
-    events_result = service.events().list(calendarId='primary', timeMin=now,
-                                          maxResults=amount, singleEvents=True,
-                                          orderBy='startTime').execute()
-    events = events_result.get('items', [])
+    sync_local_store(service)
+    events = stored_events_after(now, amount)
 
     if not events:
         print('No upcoming events found.')
@@ -238,158 +1384,729 @@ def get_next_event(service,amount=1):
         print(start, event['summary'])
     return events
 
-def ask_the_bot(question, context=[], temperature=0.05, bot = 'gpt-3.5-turbo'):
+LLM_CACHE_SIZE = 256
+LLM_CACHE_MAX_TEMPERATURE = 0.2
+LLM_CACHE_TTL = 7 * 24 * 60 * 60
+LLM_CACHE_STATS = {'hits': 0, 'misses': 0, 'bypassed': 0}
+llm_cache_enabled = True
+llm_cache = OrderedDict()
+llm_cache_lock = threading.Lock()
+
+def llm_cache_key(bot, temperature, messages):
+    return hashlib.sha256(json.dumps([bot, temperature, messages], sort_keys=True).encode()).hexdigest()
+
+def cached_llm_response(key):
+    with llm_cache_lock:
+        if key in llm_cache:
+            llm_cache.move_to_end(key)
+            return llm_cache[key]
+    with store_lock:
+        row = get_store().execute("SELECT response FROM llm_responses WHERE key=? AND created > ?",
+                                  (key, time.time() - LLM_CACHE_TTL)).fetchone()
+    if row:
+        remember_llm_response(key, row[0], persist=False)
+        return row[0]
+    return None
+
+def remember_llm_response(key, response, persist=True):
+    with llm_cache_lock:
+        llm_cache[key] = response
+        llm_cache.move_to_end(key)
+        while len(llm_cache) > LLM_CACHE_SIZE:
+            llm_cache.popitem(last=False)
+    if persist:
+        with store_lock:
+            store = get_store()
+            store.execute("INSERT OR REPLACE INTO llm_responses VALUES (?, ?, ?)", (key, response, time.time()))
+            store.execute("DELETE FROM llm_responses WHERE created <= ?", (time.time() - LLM_CACHE_TTL,))
+            store.commit()
+
+def llm_cache_stats():
+    lookups = LLM_CACHE_STATS['hits'] + LLM_CACHE_STATS['misses']
+    hit_rate = LLM_CACHE_STATS['hits'] / lookups if lookups else 0
+    return dict(LLM_CACHE_STATS, hit_rate=hit_rate)
+
+TOKEN_USAGE = {'prompt': 0, 'completion': 0, 'calls': 0}
+token_usage_lock = threading.Lock()
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text and JSON
+    return len(text) // 4 + 1
+
+def record_token_usage(prompt_tokens, completion_tokens):
+    annotate_span(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    with token_usage_lock:
+        TOKEN_USAGE['prompt'] += prompt_tokens
+        TOKEN_USAGE['completion'] += completion_tokens
+        TOKEN_USAGE['calls'] += 1
+
+def reset_token_usage():
+    with token_usage_lock:
+        for key in TOKEN_USAGE:
+            TOKEN_USAGE[key] = 0
+
+def report_token_usage(command_name):
+    if TOKEN_USAGE['calls']:
+        print(f"\n{command_name} used {TOKEN_USAGE['prompt']} prompt and {TOKEN_USAGE['completion']} completion tokens over {TOKEN_USAGE['calls']} GPT call(s).")
+
+stream_responses = True
+TIME_WINDOW_PATTERN = r"\d{4}-\d{2}-\d{2} \d{2}:\d{2} to \d{4}-\d{2}-\d{2} \d{2}:\d{2}"
+streamed_objects = OrderedDict()
+background_executor = None
+background_lock = threading.Lock()
+
+def run_in_background(function, *args):
+    global background_executor
+    with background_lock:
+        if background_executor is None:
+            background_executor = ThreadPoolExecutor(max_workers=4)
+    return background_executor.submit(with_tenant(function), *args)
+
+class JSONObjectStreamParser:
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.current = []
+        self.failed = 0
+
+    def feed(self, text):
+        objects = []
+        for character in text:
+            if self.depth > 0:
+                self.current.append(character)
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif character == '\\':
+                    self.escaped = True
+                elif character == '"':
+                    self.in_string = False
+            elif character == '"' and self.depth > 0:
+                self.in_string = True
+            elif character == '{':
+                if self.depth == 0:
+                    self.current = ['{']
+                self.depth += 1
+            elif character == '}' and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    try:
+                        objects.append(json.loads(''.join(self.current)))
+                    except json.JSONDecodeError:
+                        self.failed += 1
+        return objects
+
+    def complete(self):
+        # Every object that started also parsed, so nothing was dropped
+        return not self.failed and self.depth == 0
+
+class StreamWatcher:
+    def __init__(self, echo=False, on_time_window=None, on_object=None):
+        self.echo = echo
+        self.on_time_window = on_time_window
+        self.on_object = on_object
+        self.reset()
+
+    def reset(self):
+        self.text = ""
+        self.time_window = None
+        self.objects = []
+        self.parser = JSONObjectStreamParser()
+
+    def feed(self, text):
+        if self.echo:
+            print(text, end="", flush=True)
+        self.text += text
+        if self.time_window is None:
+            match = re.search(TIME_WINDOW_PATTERN, self.text[-(len(text) + 40):])
+            if match:
+                self.time_window = tuple(match.group().split(" to "))
+                if self.on_time_window:
+                    self.on_time_window(*self.time_window)
+        for parsed_object in self.parser.feed(text):
+            self.objects.append(parsed_object)
+            if self.on_object:
+                self.on_object(parsed_object)
+
+def prefetch_weather(event):
+    if isinstance(event, dict) and event.get('start_datetime'):
+        run_in_background(get_weather, event['start_datetime'], event.get('location'))
+
+def cached_chat_completion(bot, messages, temperature, use_cache=True, watcher=None):
+    # The cache is checked before the rate limiter, so hits never wait for a token behind real calls
+    key = None
+    if use_cache and llm_cache_enabled and temperature <= LLM_CACHE_MAX_TEMPERATURE:
+        key = llm_cache_key(bot, temperature, messages)
+        response = cached_llm_response(key)
+        if response is not None:
+            with trace_span('openai', 'chat_completion', model=bot, cache_hit=True,
+                            request_bytes=sum(len(message["content"]) for message in messages)):
+                LLM_CACHE_STATS['hits'] += 1
+                if watcher is not None:
+                    watcher.reset()
+                    watcher.feed(response)
+            return response
+        LLM_CACHE_STATS['misses'] += 1
+    else:
+        LLM_CACHE_STATS['bypassed'] += 1
+    response = call_with_backoff('openai', chat_completion, bot, messages, temperature, watcher)
+    if key is not None:
+        remember_llm_response(key, response)
+    return response
+
+def chat_completion(bot, messages, temperature, watcher=None):
+    annotate_span(model=bot, request_bytes=sum(len(message["content"]) for message in messages))
+    if watcher is not None:
+        watcher.reset()
+    if watcher is not None and stream_responses:
+        response = ""
+        for chunk in get_openai().ChatCompletion.create(
+            model=bot,
+            messages=messages,
+            temperature=temperature,
+            stream=True
+        ):
+            text = chunk["choices"][0]["delta"].get("content") or ""
+            if text:
+                response += text
+                watcher.feed(text)
+        # Streamed responses carry no usage block, so estimate it
+        record_token_usage(sum(estimate_tokens(message["content"]) for message in messages), estimate_tokens(response))
+    else:
+        completion = get_openai().ChatCompletion.create(
+            model=bot,
+            messages=messages,
+            temperature=temperature
+        )
+        response = completion["choices"][0]["message"]["content"]
+        usage = completion.get("usage") or {}
+        record_token_usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+        if watcher is not None:
+            watcher.feed(response)
+    return response
+
+def ask_the_bot(question, context=[], temperature=0.05, bot = 'gpt-3.5-turbo', use_cache=True):
     context.append({"role": "user", "content": question})
-    max_resends = 2
-    request_resends = 0
-    while request_resends <= max_resends:
-        try:
-            response = openai.ChatCompletion.create(
-                model=bot,
-                messages=context,
-                temperature=temperature
-            )
-            return response["choices"][0]["message"]["content"]
-        except Exception as e:
-            print()
-            print(f"An error occured. Resending ({request_resends}/{max_resends})...")
-            request_resends = request_resends + 1
-            time.sleep(5)
-    print("\nAll requests failed! Error: ",e)
-    return []
+    try:
+        return cached_chat_completion(bot, context, temperature, use_cache)
+    except Exception as e:
+        print("\nAll requests failed! Error: ",e)
+        return []
 
 def to_message(message,role):
     return {"content": message, "role": role}
 
-def converse_the_bot(context, temperature=0.2, bot='gpt-3.5-turbo'):
-    max_resends = 2
-    request_resends = 0
-    while request_resends <= max_resends:
-        try:
-            response = openai.ChatCompletion.create(
-                model=bot,
-                messages=context,
-                temperature=temperature
-            )
-            return response["choices"][0]["message"]["content"]
-        except Exception as e:
-            print(e)
-            print(f"An error occured. Resending ({request_resends}/{max_resends})...")
-            request_resends = request_resends + 1
-            time.sleep(5)
-    print("\nAll requests failed!")
-    return []
+def converse_the_bot(context, temperature=0.2, bot='gpt-3.5-turbo', use_cache=True, watcher=None):
+    try:
+        return cached_chat_completion(bot, context, temperature, use_cache, watcher)
+    except Exception as e:
+        print("\nAll requests failed! Error: ", e)
+        return []
 
-def discuss_until_ok(prompt_to_bot,bot='gpt-3.5-turbo',temperature = 0.2):
+def discuss_until_ok(prompt_to_bot,bot='gpt-3.5-turbo',temperature = 0.2, use_cache=True, on_time_window=None, on_object=None):
     print(f"User: {prompt_to_bot}\n")
     context = []
     context.append(to_message(prompt_to_bot,"user"))
+    revised = False
     while True:
-        from_bot = converse_the_bot(context,bot=bot, temperature=temperature)
+        watcher = StreamWatcher(stream_responses, on_time_window, on_object)
+        if stream_responses:
+            print("Bot response: ", end="", flush=True)
+        from_bot = converse_the_bot(context,bot=bot, temperature=temperature, use_cache=use_cache, watcher=watcher)
         context.append(to_message(from_bot,"assistant"))
-        print(f"Bot response: {from_bot}\n")
+        if stream_responses:
+            print("\n")
+        else:
+            print(f"Bot response: {from_bot}\n")
+        if watcher.objects and watcher.parser.complete() and isinstance(from_bot, str):
+            streamed_objects[from_bot] = watcher.objects
+            while len(streamed_objects) > 16:
+                streamed_objects.popitem(last=False)
         
+        if revised and getattr(command_state, 'policy', None) is not None:
+            # Answers given ahead of time would repeat the same feedback forever, so they get one round
+            break
         to_bot = get_input("Ok?","This is okay.")
         context.append(to_message(to_bot,"user"))
 
         if to_bot == "This is okay.":
             break
+        revised = True
 
         # Reset to gpt-3.5 for cost
         bot='gpt-3.5-turbo'
     print()
     return from_bot
 
+PROMPT_TOKEN_BUDGET = 1500
+PROMPT_DESCRIPTION_LIMIT = 120
+
+def compact_reminders(reminders):
+    # Popups are plain minutes, other methods keep their name, like "email:30"
+    if not reminders or reminders.get('useDefault'):
+        return "default"
+    return [override['minutes'] if override.get('method', 'popup') == 'popup' else f"{override['method']}:{override['minutes']}"
+            for override in reminders.get('overrides', [])]
+
+REMINDER_PATTERN = r"(?:(popup|email) ?: ?)?(\d+) ?(m|mins?|minutes?|h|hours?|d|days?)?"
+REMINDER_UNITS = {'h': 60, 'd': 24 * 60}
+
+def expand_reminder(reminder):
+    # GPT may answer with the compact form, Google's own override objects or words like "10 minutes"
+    if isinstance(reminder, dict):
+        method, minutes = reminder.get('method', 'popup'), reminder.get('minutes')
+        if method in ['popup', 'email'] and isinstance(minutes, int) and not isinstance(minutes, bool) and minutes >= 0:
+            return {'method': method, 'minutes': minutes}
+        return None
+    if isinstance(reminder, bool) or not isinstance(reminder, (int, str)):
+        return None
+    match = re.fullmatch(REMINDER_PATTERN, str(reminder).strip().lower())
+    if not match:
+        return None
+    unit = (match.group(3) or 'm')[0]
+    return {'method': match.group(1) or 'popup', 'minutes': int(match.group(2)) * REMINDER_UNITS.get(unit, 1)}
+
+def expand_reminders(reminders):
+    # Returns None if GPT left the reminders out or they can't be read, so the event keeps the ones it has
+    if reminders is None:
+        return None
+    if reminders == "default":
+        return {'useDefault': True}
+    if isinstance(reminders, dict):
+        if reminders.get('useDefault'):
+            return {'useDefault': True}
+        reminders = reminders.get('overrides', [])
+    if not isinstance(reminders, list):
+        reminders = [reminders]
+    overrides = []
+    for reminder in reminders:
+        override = expand_reminder(reminder)
+        if override is None:
+            print(f"Ignoring reminders {json.dumps(reminders)} from GPT, since {json.dumps(reminder)} isn't a reminder.")
+            return None
+        overrides.append(override)
+    return {'useDefault': False, 'overrides': overrides}
+
+def encode_events_for_prompt(events, fields):
+    # Swap long calendar ids for short handles and keep only the fields the command needs
+    handles = {}
+    encoded = []
+    for number, event in enumerate(events, start=1):
+        handle = f"e{number}"
+        handles[handle] = event
+        compact = {'id': handle}
+        for field in fields:
+            value = event.get(field)
+            if field == 'reminders':
+                value = compact_reminders(value)
+            elif field == 'description':
+                if not value:
+                    continue
+                if len(value) > PROMPT_DESCRIPTION_LIMIT:
+                    value = value[:PROMPT_DESCRIPTION_LIMIT] + "..."
+            compact[field] = value
+        encoded.append(compact)
+    return encoded, handles
+
+def chunk_events_for_budget(encoded, budget=PROMPT_TOKEN_BUDGET):
+    chunks = [[]]
+    used = 0
+    for event in encoded:
+        cost = estimate_tokens(json.dumps(event, ensure_ascii=False, separators=(',', ':')))
+        if chunks[-1] and used + cost > budget:
+            chunks.append([])
+            used = 0
+        chunks[-1].append(event)
+        used += cost
+    return chunks
+
+def decode_event_handles(objects, handles):
+    decoded = []
+    for obj in objects:
+        handle = obj.get('id') if isinstance(obj, dict) else obj
+        if handle not in handles:
+            print(f"Ignoring unknown event {handle} from GPT.")
+            continue
+        obj = dict(obj) if isinstance(obj, dict) else {}
+        obj['id'] = handles[handle]['id']
+        if 'reminders' in obj:
+            obj['reminders'] = expand_reminders(obj['reminders'])
+            if obj['reminders'] is None:
+                del obj['reminders']
+        decoded.append(obj)
+    return decoded
+
+def discuss_events(events, fields, prompt_for):
+    # Run one discussion per chunk of the window that fits the token budget
+    encoded, handles = encode_events_for_prompt(events, fields)
+    chunks = chunk_events_for_budget(encoded)
+    if len(chunks) > 1:
+        print(f"Splitting {len(encoded)} events into {len(chunks)} prompts to stay within the token budget.")
+    results = []
+    for chunk in chunks:
+        response = discuss_until_ok(prompt_for(json.dumps(chunk, ensure_ascii=False, separators=(',', ':'))))
+        results.extend(decode_event_handles(try_to_load_json_from_string(response), handles))
+    return results
+
 def delete_events_from_string(service, planning_prompt):
-    events = json.loads(events_from_prompt(service,planning_prompt))
-    for e in events:
-        e.pop('description')
-        e.pop('reminders')
-    events = json.dumps(events)
-
-    today = datetime.datetime.now().strftime('%Y-%m-%d, %A')
-    time = datetime.datetime.now().strftime('%H:%M')
-    if events:
-        delete_events_prompt = f"From this query: \"{planning_prompt} [sent {today}, {time}]\", do as follows: 1. Identify the intent of the query. 2. Pick out the ids of any events from the JSON array below that are described by the intent or query. 3. Make an array consisting of just the ids of the to-be deleted events correlating to the titles/summaries from step 2. JSON Array: {events}."
-        delete_events_response = discuss_until_ok(delete_events_prompt)
-        deletable_ids = try_to_load_json_from_string(delete_events_response)
+    context = events_from_prompt(service,planning_prompt)
+    today = get_now().strftime('%Y-%m-%d, %A')
+    time = get_now().strftime('%H:%M')
+    if context.events:
+        events = context.summaries()
+        delete_events_prompt = lambda events_json: f"From this query: \"{planning_prompt} [sent {today}, {time}]\", do as follows: 1. Identify the intent of the query. 2. Pick out the ids of any events from the JSON array below that are described by the intent or query. 3. Make a JSON array of objects with just the \"id\" key of the to-be deleted events correlating to the titles/summaries from step 2. JSON Array: {events_json}."
+        deletable_ids = [obj['id'] for obj in discuss_events(events, ['start', 'end', 'summary'], delete_events_prompt)]
     
-        for id in deletable_ids:
-            approved_ids = []
-            event = service.events().get(calendarId='primary', eventId=id).execute()
-            print(f"You are about to delete event: {event['summary']} from your calendar.")
-            approval = get_input("Confirm changes?", "no")
-            if approval == 'no' or approval == 'n':
-                continue
-            elif ((approval == 'no to all' or approval == 'nn') and get_input('This will delete no events, even ones you have approved for deletion. Write \'yes\' to confirm.') == 'yes'):
-                return []
-            elif (approval == 'yes to all' or approval == 'yy') and get_input('This will delete all the detected events, even ones you have disapproved for deletion. Write \'yes\' to confirm') == 'yes':
-                approved_ids = deletable_ids
-                break
-            else:
-                approved_ids.append(id)
-
-        delete_events(service, approved_ids)
+        approved_ids = []
+        with console_lock:
+            for id in deletable_ids:
+                event = context.events[id]
+                print(f"You are about to delete event: {event['summary']} from your calendar.")
+                approval = get_input("Confirm changes?", "no")
+                if approval == 'no' or approval == 'n':
+                    continue
+                elif ((approval == 'no to all' or approval == 'nn') and get_input('This will delete no events, even ones you have approved for deletion. Write \'yes\' to confirm.') == 'yes'):
+                    return []
+                elif (approval == 'yes to all' or approval == 'yy') and get_input('This will delete all the detected events, even ones you have disapproved for deletion. Write \'yes\' to confirm') == 'yes':
+                    approved_ids = deletable_ids
+                    break
+                else:
+                    approved_ids.append(id)
+
+        delete_events(service, approved_ids, context)
     return []
 
 def generate_events_from_context(service, planning_prompt):
-    events = events_from_prompt(service, planning_prompt)
+    print()
+    print("Identifying time window from prompt...")
+    start_time, end_time = time_window_from_prompt(planning_prompt, None if free_busy_only else service, weather=True)
+    if free_busy_only:
+        # Only when the calendars are busy, not what is planned, so all-day plans are left out
+        print(f"Checking busy times in {', '.join([active_calendar()] + active_busy_calendars())}...")
+        busy = get_busy_times(service, [active_calendar()] + active_busy_calendars(), start_time, end_time)
+        events = merge_busy_periods([period for periods in busy.values() for period in periods])
+        print_busy_periods(events)
+    else:
+        events = get_events_between_times(service, start_time, end_time) or []
+        if active_busy_calendars():
+            print(f"Checking busy times in {', '.join(active_busy_calendars())}...")
+            busy = get_busy_times(service, active_busy_calendars(), start_time, end_time)
+            events = events + merge_busy_periods([period for periods in busy.values() for period in periods])
 
-    local_tz = get_localzone()
-    current_datetime = datetime.datetime.now(local_tz)
+    current_datetime = get_now()
     day = current_datetime.strftime('%A')
     today = current_datetime.date().isoformat()
     time = current_datetime.time().strftime('%H:%M:%S')
     tz_offset = current_datetime.strftime('%z')[:3]+":"+current_datetime.strftime('%z')[3:]
 
-    if not events:
-        event_string = "no plans"
+    all_day_events = [event for event in events if 'T' not in event['start']]
+    index = EventIndex([event for event in events if 'T' in event['start']])
+    free_slots = index.free_slots(time_to_timestamp(start_time), time_to_timestamp(end_time))
+    if free_slots:
+        free_string = ", ".join(f"{timestamp_to_time(start)} to {timestamp_to_time(end)}" for start, end in free_slots)
     else:
-        events = try_to_load_json_from_string(events)
-        event_strings = [f"{event['summary']}, starting at {event['start']}, ending at {event['end']}" for event in events]
-        event_string = ", ".join(event_strings)
+        free_string = "none"
+    if all_day_events:
+        free_string += " (all-day plans: " + ", ".join(f"{event['summary']} on {event['start']}" for event in all_day_events) + ")"
 
-    new_events_prompt = f"Given the following current date and time: {day}, {today}T{time}:00, the following sequence of preexisting plans: {event_string} and planning prompt: '{planning_prompt}', do the following. 1. Identify the intent of the prompt. 2. Find any completely free time windows between the preexisting plans to use for new events. If none exists, after the events is fine. 3. In detail, list your intended additions with respect to the query. 4. Make a new JSON array consisting of just the additions with the following keys: summary, start_datetime,  end_datetime, description, and reminder (int, minutes), in an array that can be parsed to create calendar events. Please use 1-2 emojis per complex sentence in the title and description to make them more personal."
+    new_events_prompt = f"Given the following current date and time: {day}, {today}T{time}:00, the following completely free time windows between the preexisting plans: {free_string} and planning prompt: '{planning_prompt}', do the following. 1. Identify the intent of the prompt. 2. Pick free time windows from the list to use for new events. If none fits, after the last window is fine. 3. In detail, list your intended additions with respect to the query. 4. Make a new JSON array consisting of just the additions with the following keys: summary, start_datetime,  end_datetime, description, location (only if a place is mentioned), and reminder (int, minutes), in an array that can be parsed to create calendar events. Please use 1-2 emojis per complex sentence in the title and description to make them more personal."
 
     print()
-    new_events_response = discuss_until_ok(new_events_prompt)
+    new_events_response = discuss_until_ok(new_events_prompt, on_object=prefetch_weather)
     events_json = try_to_load_json_from_string(new_events_response)
-    approved_events = []
-    for event in events_json:
-        print()
-        print(f"Add event: {event['summary']} to calendar?")
-        approval = get_input("Confirm changes?", "yes")
-        if approval == 'no' or approval == 'n':
-            continue
-        elif ((approval == 'no to all' or approval == 'nn') and get_input('This will add no new events, even ones you have approved to the calender. Confirm?', 'yes') == 'yes'):
-            return []
-        elif (approval == 'yes to all' or approval == 'yy') and get_input('This will add all new events, even ones you have disapproved to the calender. Confirm?', 'yes') == 'yes':
-            return events_json
-        else:
-            approved_events.append(event)
-    return approved_events
+    return approve_new_events(drop_conflicting_events(events_json, index))
 
+def merge_busy_periods(periods):
+    merged = []
+    for start, end in sorted((time_to_timestamp(period['start']), time_to_timestamp(period['end'])) for period in periods):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [{'start': timestamp_to_time(start, "%Y-%m-%dT%H:%M:%S%z"), 'end': timestamp_to_time(end, "%Y-%m-%dT%H:%M:%S%z"), 'summary': "Busy"}
+            for start, end in merged]
 
-def time_window_from_prompt(planning_prompt):
-    today = datetime.datetime.now().strftime('%Y-%m-%d, %A')
-    time = datetime.datetime.now().strftime('%H:%M')
+def print_busy_periods(periods):
+    print()
+    if not periods:
+        print("No busy times found.")
+    for period in periods:
+        print(f"Busy from {timestamp_to_time(time_to_timestamp(period['start']))} to {timestamp_to_time(time_to_timestamp(period['end']), '%H:%M')}")
+
+def drop_conflicting_events(events_json, index):
+    # Overlaps are caught before the confirmation loop, so turning one down doesn't cost another GPT round trip
+    kept = []
+    with console_lock:
+        for event in events_json:
+            try:
+                start = parse_date_time(event['start_datetime']).timestamp()
+                end = parse_date_time(event['end_datetime']).timestamp()
+            except (KeyError, TypeError, ValueError):
+                kept.append(event)
+                continue
+            conflicts = index.events_overlapping(start, end)
+            if not conflicts:
+                kept.append(event)
+                continue
+            conflict_string = ", ".join(f"{conflict.get('summary') or 'Busy'} ({timestamp_to_time(time_to_timestamp(conflict['start']), '%H:%M')} to "
+                                        f"{timestamp_to_time(time_to_timestamp(conflict['end']), '%H:%M')})" for conflict in conflicts)
+            print()
+            print(f"{event['summary']} overlaps {conflict_string}.")
+            if get_input("Keep it anyway?", "no") in ['yes', 'y']:
+                kept.append(event)
+    return kept
+
+
+LOCAL_TIME_WINDOW_CONFIDENCE = 0.75
+local_time_windows = True
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+MONTHS = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august',
+          'september', 'october', 'november', 'december']
+WEEKDAY_PATTERN = r"(mon(?:day)?|tue(?:s(?:day)?)?|wed(?:nesday)?|thu(?:rs(?:day)?)?|fri(?:day)?|sat(?:urday)?|sun(?:day)?)"
+MONTH_PATTERN = r"(jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)"
+CLOCK_PATTERN = r"\d{1,2}(?::\d{2})? ?(?:am|pm)?"
+NUMBER_WORDS = {'a': 1, 'an': 1, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7}
+DAY_PARTS = {
+    'morning': ((6, 0), (12, 0)),
+    'noon': ((11, 0), (14, 0)),
+    'lunch': ((11, 0), (14, 0)),
+    'afternoon': ((12, 0), (18, 0)),
+    'evening': ((18, 0), (23, 59)),
+    'tonight': ((18, 0), (23, 59)),
+    'night': ((20, 0), (23, 59)),
+}
+DATE_HINTS = (r"\d|/|\b(year|rest of|from now|in may|christmas|xmas|easter|halloween|thanksgiving|holidays?|eve|sun|sat|wed|january|february|march|april|june|july|august|september|october|november|december|"
+              r"jan|feb|mar|apr|jun|jul|aug|sept?|oct|nov|dec)\b")
+MOVE_DESTINATION_PATTERN = r"\b(?:move|moving|reschedule|push|shift|postpone|change)\b.*?(\b(?:to|until|till)\b.*?)(?=\band\b|$)"
+VAGUE_TIME_WORDS = r"\b(soon|later|recent|recently|upcoming|before|after|until|since|earlier|ago|past|every|weekly|daily|when|once)\b"
+
+def month_number(name):
+    return [month[:3] for month in MONTHS].index(name[:3]) + 1
+
+def parse_clock(clock, meridiem=None):
+    match = re.fullmatch(r"(\d{1,2})(?::(\d{2}))? ?(am|pm)?", clock.strip())
+    if not match:
+        return None
+    hour = int(match.group(1))
+    minute = int(match.group(2) or 0)
+    meridiem = match.group(3) or meridiem
+    if meridiem == 'pm' and hour < 12:
+        hour += 12
+    if meridiem == 'am' and hour == 12:
+        hour = 0
+    if hour > 23 or minute > 59:
+        return None
+    return hour, minute
+
+def afternoon_clock(clock, parsed, parts):
+    # Returns the clock and whether it was a guess. Hours without am/pm before 7 are rarely meant as early morning.
+    if re.search(r"am|pm", clock) or clock.startswith('0') or parsed[0] >= 12:
+        return parsed, False
+    if any(part in ['afternoon', 'evening', 'tonight', 'night'] for part in parts):
+        return (parsed[0] + 12, parsed[1]), False
+    if parsed[0] < 7:
+        return (parsed[0] + 12, parsed[1]), True
+    return parsed, False
+
+def local_time_window(planning_prompt, now=None):
+    if now is None:
+        now = get_now().replace(tzinfo=None)
+    today = now.date()
+    text = planning_prompt.lower()
+    days = []
+    taken = []
+    rolled_over_year = False
+
+    def unclaimed(match):
+        if any(match.start() < end and start < match.end() for start, end in taken):
+            return False
+        taken.append(match.span())
+        return True
+
+    def add_days(start, end=None):
+        days.append((start, end or start))
+
+    # Where an event is moved to isn't where it is now, so leave the destination out of the window
+    destination = re.search(MOVE_DESTINATION_PATTERN, text)
+    if destination:
+        taken.append(destination.span(1))
+        window_text = text[:destination.start(1)] + text[destination.end(1):]
+    else:
+        window_text = text
+
+    for match in re.finditer(r"\b(\d{4})-(\d{2})-(\d{2})\b", text):
+        if unclaimed(match):
+            add_days(datetime.date(int(match.group(1)), int(match.group(2)), int(match.group(3))))
+    for pattern, day_group, month_group in [
+            (r"\b(\d{1,2})(?:st|nd|rd|th)?(?: of)? " + MONTH_PATTERN + r"\b(?:,? (\d{4}))?", 1, 2),
+            (r"\b" + MONTH_PATTERN + r"(?: the)? (\d{1,2})(?:st|nd|rd|th)?\b(?:,? (\d{4}))?", 2, 1)]:
+        for match in re.finditer(pattern, text):
+            if not unclaimed(match):
+                continue
+            year = int(match.group(3)) if match.group(3) else today.year
+            try:
+                date = datetime.date(year, month_number(match.group(month_group)), int(match.group(day_group)))
+            except ValueError:
+                continue
+            if not match.group(3) and (today - date).days > 60:
+                date = date.replace(year=year + 1)
+                rolled_over_year = True
+            add_days(date)
+    for pattern, offset in [(r"\bday after tomorrow\b", 2), (r"\btomorrow\b", 1),
+                            (r"\btoday\b|\btonight\b|\bthis (?:morning|afternoon|evening)\b", 0), (r"\byesterday\b", -1)]:
+        for match in re.finditer(pattern, text):
+            if unclaimed(match):
+                add_days(today + datetime.timedelta(days=offset))
+    for match in re.finditer(r"\bin (\d+|a|an|one|two|three|four|five|six|seven) (day|week)s?\b", text):
+        if unclaimed(match):
+            amount = int(match.group(1)) if match.group(1).isdigit() else NUMBER_WORDS[match.group(1)]
+            add_days(today + datetime.timedelta(days=amount * (7 if match.group(2) == 'week' else 1)))
+    for match in re.finditer(r"\b(?:the )?(?:next|coming) (\d+) days\b", text):
+        if unclaimed(match):
+            add_days(today, today + datetime.timedelta(days=int(match.group(1))))
+    for match in re.finditer(r"\b(?:(this|next) )?weekend\b", text):
+        if unclaimed(match):
+            saturday = today + datetime.timedelta(days=(5 - today.weekday()) % 7 - (7 if today.weekday() == 6 else 0))
+            if match.group(1) == 'next':
+                saturday += datetime.timedelta(days=7)
+            add_days(saturday, saturday + datetime.timedelta(days=1))
+    for match in re.finditer(r"\b(this|next|last) week\b", text):
+        if unclaimed(match):
+            monday = today - datetime.timedelta(days=today.weekday())
+            if match.group(1) == 'this':
+                add_days(today, monday + datetime.timedelta(days=6))
+            else:
+                monday += datetime.timedelta(days=7 if match.group(1) == 'next' else -7)
+                add_days(monday, monday + datetime.timedelta(days=6))
+    for match in re.finditer(r"\b(this|next|last) month\b", text):
+        if unclaimed(match):
+            month = today.month + {'this': 0, 'next': 1, 'last': -1}[match.group(1)]
+            year = today.year + (month - 1) // 12
+            month = (month - 1) % 12 + 1
+            first = datetime.date(year, month, 1)
+            last = datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+            add_days(today if match.group(1) == 'this' else first, last)
+    for match in re.finditer(r"\b(?:(this|next|last|on|coming) )?" + WEEKDAY_PATTERN + r"s?\b", text):
+        if match.group(2) in ['sun', 'sat', 'wed'] and not match.group(1):
+            # On their own these are as likely to be ordinary words, so they're left to GPT as date hints
+            continue
+        if unclaimed(match):
+            weekday = [day[:3] for day in WEEKDAYS].index(match.group(2)[:3])
+            if match.group(1) == 'last':
+                add_days(today - datetime.timedelta(days=(today.weekday() - weekday - 1) % 7 + 1))
+            elif match.group(1) == 'next':
+                add_days(today + datetime.timedelta(days=(weekday - today.weekday() - 1) % 7 + 1))
+            else:
+                add_days(today + datetime.timedelta(days=(weekday - today.weekday()) % 7))
+    for match in re.finditer(r"\bthe (\d{1,2})(?:st|nd|rd|th)\b", text):
+        if unclaimed(match):
+            try:
+                date = today.replace(day=int(match.group(1)))
+            except ValueError:
+                continue
+            if date < today:
+                date = (date.replace(day=1) + datetime.timedelta(days=32)).replace(day=date.day)
+            add_days(date)
+
+    confidence = 0.95
+    if len(set(days)) > 1:
+        confidence = 0.3
+    if rolled_over_year:
+        confidence = min(confidence, 0.6)
+    first_day, last_day = days[0] if days else (today, today)
+    start = datetime.datetime.combine(first_day, datetime.time(0, 0))
+    end = datetime.datetime.combine(last_day, datetime.time(23, 59))
+
+    parts = [part for part in DAY_PARTS if re.search(r"\b" + part + r"\b", window_text)]
+    clock_ranges = []
+    for match in re.finditer(r"\b(?:from |between )?(" + CLOCK_PATTERN + r") ?(?:-|to|until|till|and) ?(" + CLOCK_PATTERN + r")\b", text):
+        if not unclaimed(match):
+            continue
+        meridiem = re.search(r"(am|pm)$", match.group(2))
+        first = parse_clock(match.group(1), meridiem.group(1) if meridiem else None)
+        second = parse_clock(match.group(2))
+        if first and second and (':' in match.group(0) or 'm' in match.group(0) or match.group(0).startswith(('from', 'between'))):
+            if not re.search(r"am|pm", match.group(0)):
+                first, first_guessed = afternoon_clock(match.group(1), first, parts)
+                second, second_guessed = afternoon_clock(match.group(2), second, parts)
+                if first_guessed or second_guessed:
+                    confidence = min(confidence, 0.8)
+            clock_ranges.append((first, second))
+    clocks = []
+    for match in re.finditer(r"\b(?:at (" + CLOCK_PATTERN + r")|(\d{1,2}(?::\d{2})? ?(?:am|pm))|(\d{1,2}:\d{2}))\b", text):
+        if not unclaimed(match):
+            continue
+        clock = next(group for group in match.groups() if group)
+        parsed = parse_clock(clock)
+        if parsed is None:
+            continue
+        parsed, guessed = afternoon_clock(clock, parsed, parts)
+        if guessed:
+            confidence = min(confidence, 0.8)
+        clocks.append(parsed)
+
+    if clock_ranges or clocks or parts:
+        if first_day != last_day:
+            confidence = min(confidence, 0.5)
+        if len(clock_ranges) + len(clocks) > 1:
+            confidence = min(confidence, 0.4)
+        if clock_ranges:
+            (start_hour, start_minute), (end_hour, end_minute) = clock_ranges[0]
+            start = start.replace(hour=start_hour, minute=start_minute)
+            end = start.replace(hour=end_hour, minute=end_minute)
+            if end <= start:
+                confidence = min(confidence, 0.4)
+        elif clocks:
+            start = start.replace(hour=clocks[0][0], minute=clocks[0][1])
+            end = start + datetime.timedelta(hours=1)
+        else:
+            start = start.replace(hour=min(DAY_PARTS[part][0] for part in parts)[0],
+                                  minute=min(DAY_PARTS[part][0] for part in parts)[1])
+            end = end.replace(hour=max(DAY_PARTS[part][1] for part in parts)[0],
+                              minute=max(DAY_PARTS[part][1] for part in parts)[1])
+    unclaimed_text = "".join(" " if any(start <= i < end for start, end in taken) else character
+                             for i, character in enumerate(text))
+    if not (days or clock_ranges or clocks or parts):
+        # Nothing matched, so today is only a guess, and not one to trust if dates are still mentioned
+        confidence = 0.5 if destination or re.search(DATE_HINTS, unclaimed_text) else 0.8
+    if re.search(VAGUE_TIME_WORDS, unclaimed_text):
+        confidence = min(confidence, 0.5)
+    return start.strftime('%Y-%m-%d %H:%M'), end.strftime('%Y-%m-%d %H:%M'), confidence
+
+def time_window_from_prompt(planning_prompt, service=None, weather=False):
+    # Given the service, each likely window starts being fetched as soon as it's known
+    if getattr(command_state, 'time_window', None):
+        return command_state.time_window
+    if local_time_windows:
+        start_time, end_time, confidence = local_time_window(planning_prompt)
+        if confidence >= LOCAL_TIME_WINDOW_CONFIDENCE:
+            print()
+            print(f"Original plans: {start_time} to {end_time}")
+            start_time = parse_date_time(start_time).replace(second=0).isoformat()
+            end_time = parse_date_time(end_time).replace(second=0).isoformat()
+            prefetch_window(service, start_time, end_time, weather)
+            return start_time, end_time
+
+    today = get_now().strftime('%Y-%m-%d, %A')
+    time = get_now().strftime('%H:%M')
     time_window_prompt = f"From this query: \"{planning_prompt} [sent {today}, {time}]\", do as follows: 1. Identify the intent of the query. 2. Explain in depth the most important times mentioned in the query. If no day information is present in the query, assume today. If no temporal hints are present in the query (other than the query time stamp), simply start at 00:00 and end at 23:59 of the same day. 3. End your response with an unambiguous time frame that covers the original/current plans from step 2. Fill out the following completely with no changes to the format: 'Original plans: YYYY-MM-DD HH:MM to YYYY-MM-DD HH:MM'."
 
     print()
-    time_window_response = discuss_until_ok(time_window_prompt)
+    time_window_response = discuss_until_ok(time_window_prompt, on_time_window=lambda start_time, end_time: prefetch_window(service, start_time, end_time, weather))
 
-    pattern = r"\d{4}-\d{2}-\d{2} \d{2}:\d{2} to \d{4}-\d{2}-\d{2} \d{2}:\d{2}"
-    match = re.search(pattern, time_window_response)
+    match = re.search(TIME_WINDOW_PATTERN, time_window_response)
 
     if match:
         time_window = match.group()
         start_time, end_time = time_window.split(" to ")
     else:
-        today = datetime.datetime.now().strftime('%Y-%m-%d')
+        today = get_now().strftime('%Y-%m-%d')
         start_time = today + " 00:00"
         end_time = today + " 23:59"
+        prefetch_window(service, start_time, end_time, weather)
         print("No time window found in the response. Assuming the entire present day.")
-        confirmation = input("Is the assumption correct? (yes/no): ")
+        confirmation = console_input("Is the assumption correct? (yes/no): ")
         if confirmation.lower() != "yes":
             start_time = get_input("Please provide the correct start time.",default_value=start_time)
             end_time = get_input("Please provide the correct end time.",default_value=end_time)
@@ -401,29 +2118,42 @@ def time_window_from_prompt(planning_prompt):
 def events_from_prompt(service,planning_prompt):
     print()
     print("Identifying time window from prompt...")
-    start_time, end_time = time_window_from_prompt(planning_prompt)
+    start_time, end_time = time_window_from_prompt(planning_prompt, service)
     print(
-        f"Fetching events between {readable_time(start_time, '%Y-%m-%dT%H:%M:%S%z')} and {readable_time(start_time, '%Y-%m-%dT%H:%M:%S%z')}.")
-    events = get_events_between_times(service,start_time,end_time)
-    return events
+        f"Fetching events between {readable_time(start_time, '%Y-%m-%dT%H:%M:%S%z')} and {readable_time(end_time, '%Y-%m-%dT%H:%M:%S%z')}.")
+    return EventContext(service, start_time, end_time)
 
 def update_events_from_string(service,planning_prompt):
-    events = events_from_prompt(service,planning_prompt)
-    today = datetime.datetime.now().strftime('%Y-%m-%d, %A')
-    time = datetime.datetime.now().strftime('%H:%M')
-    if events:
-        update_events_prompt = f"From this query: \"{planning_prompt} [sent {today}, {time}]\", do as follows: 1. Identify the intent of the query. 2. Pick out the titles/summaries of any events from the JSON array below that are discussed in the query. 3. In detail, list your intended edits to the events with respect to the query. 4. Make a new JSON array consisting of just the now revised events correlating to the titles/summaries from step 2. Make sure to be unambiguous, autonomously and intelligently making any decisions necessary to satisfy the query, and escape any special characters that have special meaning in JSON by putting backslash before it. JSON Array: {events}."
+    context = events_from_prompt(service,planning_prompt)
+    today = get_now().strftime('%Y-%m-%d, %A')
+    time = get_now().strftime('%H:%M')
+    if context.events:
+        events = context.summaries()
+        update_events_prompt = lambda events_json: f"From this query: \"{planning_prompt} [sent {today}, {time}]\", do as follows: 1. Identify the intent of the query. 2. Pick out the titles/summaries of any events from the JSON array below that are discussed in the query. 3. In detail, list your intended edits to the events with respect to the query. 4. Make a new JSON array consisting of just the now revised events correlating to the titles/summaries from step 2, keeping their ids. Reminders are \"default\" or a list of minutes, written like \"email:30\" for reminders that aren't popups. Make sure to be unambiguous, autonomously and intelligently making any decisions necessary to satisfy the query, and escape any special characters that have special meaning in JSON by putting backslash before it. JSON Array: {events_json}."
         print()
-        update_events_response = discuss_until_ok(update_events_prompt)
-        updated_events = try_to_load_json_from_string(update_events_response)
+        updated_events = discuss_events(events, ['start', 'end', 'summary', 'description', 'reminders'], update_events_prompt)
+        originals = {event['id']: event for event in events}
+        for obj in updated_events:
+            original = originals[obj['id']]
+            for field in ['summary', 'description', 'start', 'end', 'reminders']:
+                obj.setdefault(field, original[field])
+            # Descriptions were shortened for the prompt, so keep the full one unless GPT rewrote it
+            if len(original['description']) > PROMPT_DESCRIPTION_LIMIT and obj['description'].endswith("..."):
+                obj['description'] = original['description']
         event_ids = [obj['id'] for obj in updated_events]
         revised_events = [{k: v for k, v in obj.items() if k != 'id'} for obj in updated_events]
-        update_events(service,event_ids,revised_events)
+        update_events(service,event_ids,revised_events,context)
     return []
 
 def try_to_load_json_from_string(json_string):
     print()
     print("Trying to load JSON from GPT.")
+    if not isinstance(json_string, str):
+        print("Loading JSON failed, GPT did not answer.")
+        return []
+    if json_string in streamed_objects:
+        print("Loading JSON succeeded!")
+        return list(streamed_objects[json_string])
 
     start_of_json = json_string.find('{')
     end_of_json = json_string.rfind('}')+1
@@ -452,58 +2182,99 @@ def try_to_load_json_from_string(json_string):
     print("Loading JSON succeeded!")
     return loaded_json
 
+def approve_new_events(events_json):
+    with console_lock:
+        approved_events = []
+        for event in events_json:
+            print()
+            print(f"Add event: {event['summary']} to calendar?")
+            approval = get_input("Confirm changes?", "yes")
+            if approval == 'no' or approval == 'n':
+                continue
+            elif ((approval == 'no to all' or approval == 'nn') and get_input('This will add no new events, even ones you have approved to the calender. Confirm?', 'yes') == 'yes'):
+                return []
+            elif (approval == 'yes to all' or approval == 'yy') and get_input('This will add all new events, even ones you have disapproved to the calender. Confirm?', 'yes') == 'yes':
+                return events_json
+            else:
+                approved_events.append(event)
+        return approved_events
+
 def generate_events_from_string(service, planning_prompt):
-    local_tz = get_localzone()
-    current_datetime = datetime.datetime.now(local_tz)
+    current_datetime = get_now()
     day = current_datetime.strftime('%A')
     today = current_datetime.date().isoformat()
     time = current_datetime.time().strftime('%H:%M:%S')
     tz_offset = current_datetime.strftime('%z')[:3]+":"+current_datetime.strftime('%z')[3:]
 
-    new_events_prompt = f"Given the following current date and time: {day}, {today}T{time} and planning prompt: '{planning_prompt}', format the prompt's contents as JSON objects with the following keys: summary, start_datetime,  end_datetime, description, and reminder (int, minutes), in an array that can be parsed to create calendar events. Please use 1-2 emojis per complex sentence in the title and description to make them more personal."
+    new_events_prompt = f"Given the following current date and time: {day}, {today}T{time} and planning prompt: '{planning_prompt}', format the prompt's contents as JSON objects with the following keys: summary, start_datetime,  end_datetime, description, location (only if a place is mentioned), and reminder (int, minutes), in an array that can be parsed to create calendar events. Please use 1-2 emojis per complex sentence in the title and description to make them more personal."
     while not planning_prompt:
         planning_prompt = get_input("Please enter concrete events")
-        new_events_prompt = f"Given the following current date and time: {day}, {today}T{time}:00 and events: '{planning_prompt}', format them as JSON objects with the following keys: summary, start_datetime,  end_datetime, description, and reminder (int, minutes), in an array that can be parsed to create calendar events. Please use 1-2 emojis per complex sentence in the title and description to make them more personal."
+        new_events_prompt = f"Given the following current date and time: {day}, {today}T{time}:00 and events: '{planning_prompt}', format them as JSON objects with the following keys: summary, start_datetime,  end_datetime, description, location (only if a place is mentioned), and reminder (int, minutes), in an array that can be parsed to create calendar events. Please use 1-2 emojis per complex sentence in the title and description to make them more personal."
     print()
-    new_events_response = discuss_until_ok(new_events_prompt,bot='gpt-4-1106-preview',temperature=1)
+    new_events_response = discuss_until_ok(new_events_prompt,bot='gpt-4-1106-preview',temperature=1, on_object=prefetch_weather)
     events_json = try_to_load_json_from_string(new_events_response)
-    approved_events = []
-    for event in events_json:
-        print()
-        print(f"Add event: {event['summary']} to calendar?")
-        approval = get_input("Confirm changes?", "yes")
-        if approval == 'no' or approval == 'n':
-            continue
-        elif ((approval == 'no to all' or approval == 'nn') and get_input('This will add no new events, even ones you have approved to the calender. Confirm?', 'yes') == 'yes'):
-            return []
-        elif (approval == 'yes to all' or approval == 'yy') and get_input('This will add all new events, even ones you have disapproved to the calender. Confirm?', 'yes') == 'yes':
-            return events_json
-        else:
-            approved_events.append(event)
-    return approved_events
+    return approve_new_events(events_json)
 
 def completion_from_string(service, planning_prompt):
-    events = json.loads(events_from_prompt(service,planning_prompt))
-    unedited_events = [dict(e) for e in events]
-    for e in events:
-        e.pop('description')
-        e.pop('reminders')
-    events = json.dumps(events)
-    today = datetime.datetime.now().strftime('%Y-%m-%d, %A')
-    time = datetime.datetime.now().strftime('%H:%M')
-    if events:
-        update_events_prompt = f"From this query: \"{planning_prompt} [sent {today}, {time}]\", do as follows: 1. Pick out the titles/summaries of any events from the JSON array below that are discussed in the query. 2. Make a new JSON array consisting of just the events correlating to the titles/summaries from step 1. now with a green checkmark emoji (✅) prepended onto the summary. The emoji shouldn't replace or remove other emojis present and should be on the far left of it. Make sure to be unambiguous and escape any special characters that have special meaning in JSON by putting backslash before it. JSON Array: {events}."
+    context = events_from_prompt(service,planning_prompt)
+    today = get_now().strftime('%Y-%m-%d, %A')
+    time = get_now().strftime('%H:%M')
+    if context.events:
+        events = context.summaries()
+        unedited_events = {event['id']: event for event in events}
+        update_events_prompt = lambda events_json: f"From this query: \"{planning_prompt} [sent {today}, {time}]\", do as follows: 1. Pick out the titles/summaries of any events from the JSON array below that are discussed in the query. 2. Make a new JSON array consisting of just the events correlating to the titles/summaries from step 1, keeping their ids, now with a green checkmark emoji (✅) prepended onto the summary. The emoji shouldn't replace or remove other emojis present and should be on the far left of it. Make sure to be unambiguous and escape any special characters that have special meaning in JSON by putting backslash before it. JSON Array: {events_json}."
         print()
-        update_events_response = discuss_until_ok(update_events_prompt)
-        updated_events = try_to_load_json_from_string(update_events_response)
+        updated_events = discuss_events(events, ['start', 'end', 'summary'], update_events_prompt)
         event_ids = [obj['id'] for obj in updated_events]
         revised_events = [{k: v for k, v in obj.items() if k != 'id'} for obj in updated_events]
-        for e, u in zip(revised_events,unedited_events):
-            e['description'] = u['description']
-            e['reminders'] = u['reminders']
-        update_events(service,event_ids,revised_events)
+        for e, id in zip(revised_events,event_ids):
+            e['description'] = unedited_events[id]['description']
+            e['reminders'] = unedited_events[id]['reminders']
+        update_events(service,event_ids,revised_events,context)
     return []
 
+MULTIQUERY_WORKERS = 4
+WINDOWED_COMMANDS = ['EDIT', 'DELETE', 'COMPLETE', 'GET THEN MAKE']
+WRITING_COMMANDS = ['EDIT', 'DELETE', 'COMPLETE']
+
+def run_buffered(label, function, *args):
+    output = thread_output()
+    output.start_buffering(label)
+    try:
+        return function(*args)
+    finally:
+        output.stop_buffering()
+
+def run_subquery(service, action):
+    if action['function'] is None:
+        print(f"\nBot response:\nSorry, I don't know how to {action['command']} plans.")
+        return []
+    print(f"\nBot response:\nAlright, we'll {action['command']} plans!")
+    command_state.time_window = action.get('window')
+    try:
+        return action['function'](service, action['subquery'])
+    finally:
+        command_state.time_window = None
+
+def subqueries_conflict(first, second):
+    if first['command'] not in WRITING_COMMANDS and second['command'] not in WRITING_COMMANDS:
+        return False
+    if not first.get('window') or not second.get('window'):
+        return first['command'] in WINDOWED_COMMANDS and second['command'] in WINDOWED_COMMANDS
+    first_start, first_end = [time_to_timestamp(time) for time in first['window']]
+    second_start, second_end = [time_to_timestamp(time) for time in second['window']]
+    return first_start < second_end and second_start < first_end
+
+def subquery_stages(actions):
+    stages = []
+    for j, action in enumerate(actions):
+        stage = 0
+        for i in range(j):
+            if subqueries_conflict(actions[i], action):
+                stage = max(stage, stages[i] + 1)
+        stages.append(stage)
+    return stages
+
 def multiquery_from_string(service, planning_prompt):
     commands_string = ""
     invalid_commands = ["SEQUENTIALLY"]
@@ -517,34 +2288,323 @@ def multiquery_from_string(service, planning_prompt):
     subqueries_and_commands = try_to_load_json_from_string(break_down_prompt_response)
     print()
 
-    new_events = []
     for action in subqueries_and_commands:
-        action['subquery'] = f"I need just this part done: {action['subquery']}, from this list: {planning_prompt}. Everything before this in the list has been done already."
-        print(f"\nBot response:\nAlright, we'll {action['command']} plans!")
+        action['part'] = action['subquery']
+        action['subquery'] = f"I need just this part done: {action['part']}, from this list: {planning_prompt}. The other parts are taken care of separately."
+        action['function'] = None
         for command in COMMANDS:
             if action['command'] == command['name']:
-                command_function = command['command']
-        events = command_function(service, action['subquery'])
-        new_events.append(events)
-        print("Waiting 5 seconds to do next task.")
-        time.sleep(5)
+                action['function'] = command['command']
+
+    labels = [f"Part {i + 1}: {action['part']}" for i, action in enumerate(subqueries_and_commands)]
+    windowed = [i for i, action in enumerate(subqueries_and_commands) if action['command'] in WINDOWED_COMMANDS]
+    with ThreadPoolExecutor(max_workers=MULTIQUERY_WORKERS) as executor:
+        windows = executor.map(with_tenant(lambda i: run_buffered(labels[i], time_window_from_prompt, subqueries_and_commands[i]['part'], service,
+                                                                 subqueries_and_commands[i]['command'] == 'GET THEN MAKE')), windowed)
+        for i, window in zip(windowed, windows):
+            subqueries_and_commands[i]['window'] = window
+
+        stages = subquery_stages(subqueries_and_commands)
+        results = [None] * len(subqueries_and_commands)
+        for stage in range(max(stages, default=-1) + 1):
+            indices = [i for i, action_stage in enumerate(stages) if action_stage == stage]
+            futures = {i: executor.submit(with_tenant(run_buffered), labels[i], run_subquery, service, subqueries_and_commands[i])
+                       for i in indices}
+            for i in indices:
+                results[i] = futures[i].result()
+
+    new_events = []
+    for events in results:
+        new_events.extend(events or [])
     return new_events
 
-def events_from_paste(service, planning_prompt):
-    events_json = try_to_load_json_from_string(planning_prompt)
-    approved_events = []
-    for event in events_json:
-        print()
-        print(f"Add event: {event['summary']} to calendar?")
-        approval = get_input("Confirm changes?", "yes")
-        if approval == 'no' or approval == 'n':
+WEATHER_REFRESH_INTERVAL = 3 * 60 * 60
+WEATHER_REFRESH_DAYS = 7
+WEATHER_REFRESH_LIMIT = 100
+WEATHER_BLOCK_PATTERN = r"\n\nWeather \([^\n]*\):\nDescription: [^\n]*\nTemperature: [^\n]*°C"
+weather_refresher = None
+
+def refresh_event_weather(service):
+    # Re-checks the weather written into upcoming events and patches the ones whose forecast changed
+    sync_local_store(service)
+    now = get_now()
+    upcoming = []
+    for event in stored_events_between(now.isoformat(), (now + datetime.timedelta(days=WEATHER_REFRESH_DAYS)).isoformat()):
+        if 'dateTime' in event['start'] and re.search(WEATHER_BLOCK_PATTERN, event.get('description', '')):
+            upcoming.append(event)
+            if len(upcoming) >= WEATHER_REFRESH_LIMIT:
+                break
+
+    # Forecasts are cached per day and location, so this is one request for each of those
+    weathers = {}
+    patches = []
+    for event in upcoming:
+        start = event_datetime(event['start']).astimezone(lazy_import('pytz').timezone(active_timezone())).strftime('%Y-%m-%dT%H:%M:%S')
+        key = (start[:13], event.get('location'))
+        if key not in weathers:
+            weathers[key] = get_weather(start, event.get('location'))
+        if not isinstance(weathers[key], dict):
             continue
-        elif ((approval == 'no to all' or approval == 'nn') and get_input('This will add no new events, even ones you have approved to the calender. Confirm?', 'yes') == 'yes'):
-            return []
-        elif (approval == 'yes to all' or approval == 'yy') and get_input('This will add all new events, even ones you have disapproved to the calender. Confirm?', 'yes') == 'yes':
-            return events_json
+        weather_string = weather_string_for_event({'start_datetime': start, 'location': event.get('location')}, weathers[key])
+        description = re.sub(WEATHER_BLOCK_PATTERN, lambda match: weather_string, event['description'], count=1)
+        if description != event['description']:
+            patches.append((event['id'], {'description': description}, event.get('etag')))
+
+    updated = 0
+    if patches:
+        results = flush_write_queue(service, queue_writes('patch', patches))
+        updated = sum(1 for outcome, detail in results.values() if outcome == 'done')
+    return len(upcoming), updated
+
+def weather_refresher_loop(service):
+    while True:
+        thread_output().start_buffering("weather refresh")
+        try:
+            checked, updated = refresh_event_weather(service)
+            if updated:
+                print(f"Updated the weather on {updated} of {checked} upcoming event(s).")
+        except Exception as e:
+            print(f"Could not refresh the weather: {e}")
+        thread_output().stop_buffering()
+        time.sleep(WEATHER_REFRESH_INTERVAL)
+
+def start_weather_refresher(service):
+    global weather_refresher
+    if weather_refresher is None:
+        weather_refresher = threading.Thread(target=weather_refresher_loop, args=(service,), daemon=True)
+        weather_refresher.start()
+
+def refresh_weather_command(service, planning_prompt):
+    checked, updated = refresh_event_weather(service)
+    print(f"\nChecked the weather on {checked} upcoming event(s) and updated {updated}.")
+    return []
+
+IMPORT_BATCH_SIZE = 200
+IMPORT_FIELDS = ['id', 'summary', 'description', 'location', 'start', 'end', 'reminders', 'recurrence']
+EXPORT_WINDOW = ('1970-01-02T00:00:00+00:00', '2100-01-01T00:00:00+00:00')
+ICS_ESCAPES = {'n': '\n', 'N': '\n'}
+
+def unfolded_lines(lines):
+    current = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+def ics_unescape(value):
+    return re.sub(r'\\(.)', lambda match: ICS_ESCAPES.get(match.group(1), match.group(1)), value)
+
+def ics_escape(value):
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def ics_time(value, params):
+    if params.get('VALUE') == 'DATE' or len(value) == 8:
+        return {'date': datetime.datetime.strptime(value, '%Y%m%d').strftime('%Y-%m-%d')}
+    moment = datetime.datetime.strptime(value.rstrip('Z'), '%Y%m%dT%H%M%S').strftime('%Y-%m-%dT%H:%M:%S')
+    if value.endswith('Z'):
+        return {'dateTime': moment + 'Z', 'timeZone': 'UTC'}
+    return {'dateTime': moment, 'timeZone': params.get('TZID', active_timezone())}
+
+def read_ics_events(path):
+    # Parses one VEVENT at a time so files of any size use constant memory
+    with open(path, encoding='utf-8') as file:
+        event = None
+        nested = 0
+        for line in unfolded_lines(file):
+            name, _, value = line.partition(':')
+            name, *parameters = name.split(';')
+            name = name.upper()
+            params = dict(parameter.partition('=')[::2] for parameter in parameters)
+            if name == 'BEGIN':
+                if value.upper() == 'VEVENT':
+                    event = {}
+                elif event is not None:
+                    nested = nested + 1
+            elif name == 'END':
+                if nested:
+                    nested = nested - 1
+                elif value.upper() == 'VEVENT' and event is not None:
+                    yield event
+                    event = None
+            elif event is None or nested:
+                continue
+            elif name in ('DTSTART', 'DTEND'):
+                try:
+                    event['start' if name == 'DTSTART' else 'end'] = ics_time(value, params)
+                except ValueError:
+                    event['invalid'] = f"unreadable {name} '{value}'"
+            elif name in ('SUMMARY', 'DESCRIPTION', 'LOCATION'):
+                event[name.lower()] = ics_unescape(value)
+            elif name == 'UID':
+                event['iCalUID'] = value
+            elif name == 'RRULE':
+                event.setdefault('recurrence', []).append('RRULE:' + value)
+
+def read_jsonl_events(path):
+    with open(path, encoding='utf-8') as file:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield {'invalid': f"line {line_number} is not JSON ({e})"}
+                continue
+            if not isinstance(event, dict):
+                yield {'invalid': f"line {line_number} is not an event object"}
+            elif 'start_datetime' in event:
+                # The same keys GPT produces for MAKE
+                reminder = [{'method': 'popup', 'minutes': int(event['reminder'])}] if event.get('reminder') else None
+                yield event_body(event.get('summary', ''), event['start_datetime'], event.get('end_datetime', event['start_datetime']),
+                                 event.get('description', ''), reminder, event.get('location'))
+            else:
+                yield event
+
+def import_body(event):
+    if 'invalid' in event:
+        return None, event['invalid']
+    if not isinstance(event.get('start'), dict) or not ('date' in event['start'] or 'dateTime' in event['start']):
+        return None, "no start time"
+    body = {key: event[key] for key in IMPORT_FIELDS if key in event}
+    body.setdefault('summary', '(no title)')
+    if 'end' not in body:
+        if 'date' in body['start']:
+            body['end'] = {'date': (datetime.date.fromisoformat(body['start']['date']) + datetime.timedelta(days=1)).isoformat()}
         else:
-            approved_events.append(event)
+            body['end'] = dict(body['start'])
+    try:
+        if event_timestamp(body['end']) < event_timestamp(body['start']):
+            return None, "ends before it starts"
+    except (ValueError, KeyError, OverflowError) as e:
+        return None, f"unreadable time ({e})"
+    # Ids derived from the source make re-imports and replays idempotent
+    seed = event.get('iCalUID') or event.get('id') or json.dumps([body['summary'], body['start'], body['end']], sort_keys=True)
+    body['id'] = hashlib.sha1(seed.encode()).hexdigest()
+    return body, None
+
+def stored_duplicate(body, calendar_id=None):
+    calendar_id = store_key(calendar_id)
+    with store_lock:
+        store = get_store()
+        if store.execute("SELECT 1 FROM events WHERE calendar_id=? AND id=?", (calendar_id, body['id'])).fetchone():
+            return True
+        rows = store.execute("SELECT data FROM events WHERE calendar_id=? AND start_ts=? AND end_ts=?",
+                             (calendar_id, event_timestamp(body['start']), event_timestamp(body['end']))).fetchall()
+    return any(json.loads(row[0]).get('summary') == body['summary'] for row in rows)
+
+def write_import_batch(service, bodies, counts, offline):
+    keys = queue_writes('insert', [(None, body, None) for body in bodies], claim=not offline)
+    if offline:
+        counts['queued'] += len(keys)
+        return True
+    results = flush_write_queue(service, keys)
+    for key, body in zip(keys, bodies):
+        outcome, detail = results[key]
+        if outcome == 'done':
+            counts['imported'] += 1
+        elif outcome == 'pending':
+            counts['queued'] += 1
+        else:
+            counts['failed'] += 1
+            print(f"Event '{body['summary']}' could not be imported: {detail}")
+    if all(results[key][0] == 'pending' for key in keys):
+        print("Google Calendar seems unavailable. Queuing the remaining events.")
+        return True
+    return False
+
+def import_events_from_file(service, planning_prompt):
+    path = planning_prompt.strip().strip('"')
+    if not os.path.exists(path):
+        print(f"\nCould not find the file {path}.")
+        return []
+    reader = read_ics_events if path.lower().endswith('.ics') else read_jsonl_events
+    sync_local_store(service)
+    counts = {'imported': 0, 'duplicates': 0, 'invalid': 0, 'queued': 0, 'failed': 0}
+    seen_ids = set()
+    offline = False
+    batch = []
+    for number, event in enumerate(reader(path), start=1):
+        body, error = import_body(event)
+        if error:
+            print(f"Skipping event {number}: {error}.")
+            counts['invalid'] += 1
+            continue
+        if body['id'] in seen_ids or stored_duplicate(body):
+            counts['duplicates'] += 1
+            continue
+        seen_ids.add(body['id'])
+        batch.append(body)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            offline = write_import_batch(service, batch, counts, offline)
+            batch = []
+    if batch:
+        write_import_batch(service, batch, counts, offline)
+    print(f"\nImported {counts['imported']} event(s). Skipped {counts['duplicates']} duplicate(s) and {counts['invalid']} invalid event(s).")
+    if counts['failed']:
+        print(f"{counts['failed']} event(s) were rejected by Google Calendar.")
+    if counts['queued']:
+        print(f"{counts['queued']} event(s) were queued and will be sent when Google Calendar is reachable.")
+    return []
+
+def ics_time_line(name, event_time):
+    if 'dateTime' not in event_time:
+        return f"{name};VALUE=DATE:{event_time['date'].replace('-', '')}"
+    moment = event_datetime(event_time).astimezone(datetime.timezone.utc)
+    return f"{name}:{moment.strftime('%Y%m%dT%H%M%SZ')}"
+
+def ics_event(event):
+    lines = ["BEGIN:VEVENT", f"UID:{event.get('iCalUID', event['id'])}",
+             ics_time_line("DTSTART", event['start']), ics_time_line("DTEND", event['end'])]
+    for key in ['summary', 'description', 'location']:
+        if event.get(key):
+            lines.append(f"{key.upper()}:{ics_escape(event[key])}")
+    lines.extend(event.get('recurrence', []))
+    lines.append("END:VEVENT")
+    return "".join(ics_fold(line) + "\r\n" for line in lines)
+
+def ics_fold(line):
+    # Lines longer than 75 octets of UTF-8 are folded onto continuation lines, which start with a space
+    folded = []
+    current = ""
+    size = 0
+    for character in line:
+        width = len(character.encode('utf-8'))
+        if size + width > 75:
+            folded.append(current)
+            current = " "
+            size = 1
+        current += character
+        size += width
+    folded.append(current)
+    return "\r\n".join(folded)
+
+def export_events_to_file(service, planning_prompt):
+    path, _, window = planning_prompt.strip().partition(' ')
+    start_time, end_time = time_window_from_prompt(window) if window.strip() else EXPORT_WINDOW
+    ics = path.lower().endswith('.ics')
+    sync_local_store(service)
+    count = 0
+    with open(path + '.tmp', 'w', encoding='utf-8', newline='') as file:
+        if ics:
+            file.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//CalendarMe//EN\r\n")
+        for event in stored_events_between(start_time, end_time):
+            file.write(ics_event(event) if ics else json.dumps(event, ensure_ascii=False) + "\n")
+            count = count + 1
+        if ics:
+            file.write("END:VCALENDAR\r\n")
+    os.replace(path + '.tmp', path)
+    print(f"\nExported {count} event(s) to {path}.")
+    return []
+
+def events_from_paste(service, planning_prompt):
+    events_json = try_to_load_json_from_string(planning_prompt)
+    approved_events = approve_new_events(events_json)
     print(approved_events)
     return approved_events
 
@@ -556,6 +2616,7 @@ def print_help(service,planning_prompt):
     return []
 
 def manual_planning_main(service, planning_prompt=""):
+    global current_command
     choice = get_input("What would you like to do? Type help for list of commands.", "make").upper()
 
     chosen_command = None
@@ -566,9 +2627,16 @@ def manual_planning_main(service, planning_prompt=""):
 
     if chosen_command:
         print(f"\nBot response:\nAlright, we'll {chosen_command['name']} plans!")
-        if not choice == "HELP":
+        if choice not in ["HELP", "WEATHER"]:
             planning_prompt = get_input("Please enter a general plan", None)
-        return chosen_command['command'](service, planning_prompt)
+        reset_token_usage()
+        current_command = chosen_command['name']
+        try:
+            with trace_span('command', chosen_command['name']):
+                return chosen_command['command'](service, planning_prompt)
+        finally:
+            current_command = None
+            report_token_usage(chosen_command['name'])
     else:
         print("\nBot response:\nSorry, I couldn't understand your response.")
 
@@ -623,16 +2691,200 @@ COMMANDS = [{
         "name": "REGRET",
         "description": "undos the current command.",
         "command": None
+}, {
+        "name": "SEQUENTIALLY",
+        "description": "splits a query into parts and does each with the fitting command.",
+        "command": multiquery_from_string
 }, {
         "name": "PASTE",
         "description": "Makes events from an already processed request.",
         "command": events_from_paste
+}, {
+        "name": "WEATHER",
+        "description": "updates the weather written on the next week's events.",
+        "command": refresh_weather_command
+}, {
+        "name": "IMPORT",
+        "description": "adds the events in an .ics or .jsonl file, given as the plan.",
+        "command": import_events_from_file
+}, {
+        "name": "EXPORT",
+        "description": "saves events to an .ics or .jsonl file, given as the plan with an optional time window after it.",
+        "command": export_events_to_file
 }, {
     "name": "EXIT",
     "description": "exits CalendarMe.",
     "command": None
 }]
 
+HEADLESS_COMMANDS = ['MAKE', 'EDIT', 'DELETE', 'COMPLETE', 'GET THEN MAKE', 'PASTE']
+ENGINE_WORKERS = 8
+SERVER_PORT = 8765
+SERVER_SECRET_PATH = os.path.join(TOKEN_DIRECTORY, 'server_secret')
+
+class InvalidParams(ValueError):
+    pass
+
+class CalendarEngine:
+    # Runs commands without a console, answering their questions from an ApprovalPolicy.
+    # Each command acts as a signed-in user on one of their calendars.
+    def __init__(self, sessions, workers=ENGINE_WORKERS):
+        self.sessions = sessions
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers)
+
+    def run_command(self, command, plan, policy=None, window=None, user=None, calendar_id=None, timezone=None, busy_calendar_ids=None):
+        chosen_command = next((known for known in COMMANDS if known['name'] == str(command).upper()), None)
+        if chosen_command is None or chosen_command['name'] not in HEADLESS_COMMANDS:
+            raise InvalidParams(f"Unknown command {command}. Use one of {', '.join(HEADLESS_COMMANDS)}.")
+        if not plan or not isinstance(plan, str):
+            raise InvalidParams("A plan is needed.")
+        if timezone and timezone not in lazy_import('pytz').all_timezones_set:
+            raise InvalidParams(f"Unknown timezone {timezone}.")
+        if busy_calendar_ids is not None and not isinstance(busy_calendar_ids, list):
+            raise InvalidParams("busy_calendars must be a list of calendar ids.")
+        if window:
+            window = self.parse_window(window, timezone)
+        try:
+            service = self.sessions.get(user)
+        except ValueError as e:
+            raise InvalidParams(str(e))
+        policy = policy or ApprovalPolicy()
+        output = thread_output()
+        with self.slots, acting_for(user, calendar_id, timezone, busy_calendar_ids):
+            output.start_buffering(chosen_command['name'])
+            command_state.policy = policy
+            command_state.command = chosen_command['name']
+            command_state.time_window = window or None
+            started = time.perf_counter()
+            try:
+                with trace_span('command', chosen_command['name'], user=user):
+                    events = chosen_command['command'](service, plan)
+                    created = add_events_to_calendar(service, events) if events else []
+            except BaseException as error:
+                error.output = output.take()
+                raise
+            finally:
+                command_state.policy = None
+                command_state.command = None
+                command_state.time_window = None
+            return {
+                'command': chosen_command['name'],
+                'created': created or [],
+                'questions': policy.asked,
+                'output': output.take(),
+                'seconds': time.perf_counter() - started,
+            }
+
+    def parse_window(self, window, timezone=None):
+        # Same form as time_window_from_prompt returns, from e.g. ["2026-10-18 00:00", "2026-10-18 23:59"]
+        if not isinstance(window, (list, tuple)) or len(window) != 2 or not all(isinstance(time, str) for time in window):
+            raise InvalidParams("window must be a start and an end time.")
+        try:
+            start_time, end_time = [parse_date_time(time, timezone).replace(second=0).isoformat() for time in window]
+        except (ValueError, OverflowError):
+            raise InvalidParams(f"Could not read the window {window[0]} to {window[1]}.")
+        if time_to_timestamp(end_time) <= time_to_timestamp(start_time):
+            raise InvalidParams("The window must end after it starts.")
+        return start_time, end_time
+
+    async def run(self, command, plan, policy=None, window=None, user=None, calendar_id=None, timezone=None, busy_calendar_ids=None):
+        loop = lazy_import('asyncio').get_running_loop()
+        return await loop.run_in_executor(self.executor, self.run_command, command, plan, policy, window,
+                                          user, calendar_id, timezone, busy_calendar_ids)
+
+def rpc_error(request_id, code, message, data=None):
+    error = {'code': code, 'message': message}
+    if data is not None:
+        error['data'] = data
+    return {'jsonrpc': '2.0', 'error': error, 'id': request_id}
+
+def handle_rpc(engine, request):
+    if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+        return rpc_error(None, -32600, "Invalid request")
+    request_id = request.get('id')
+    params = request.get('params') or {}
+    try:
+        if not isinstance(params, dict):
+            raise InvalidParams("params must be an object.")
+        if request['method'] == 'commands':
+            result = HEADLESS_COMMANDS
+        elif request['method'] == 'run':
+            try:
+                policy = ApprovalPolicy(params.get('approve', 'default'), params.get('answers'))
+            except ValueError as e:
+                raise InvalidParams(str(e))
+            result = engine.run_command(params.get('command', ''), params.get('plan', ''), policy, params.get('window'),
+                                        params.get('user'), params.get('calendar'), params.get('timezone'), params.get('busy_calendars'))
+        else:
+            return rpc_error(request_id, -32601, f"Unknown method {request['method']}")
+    except InvalidParams as e:
+        return rpc_error(request_id, -32602, str(e))
+    except BaseException as e:
+        # Includes the console's control flow exceptions, which must not end the handler thread
+        return rpc_error(request_id, -32000, f"{type(e).__name__}: {e}", {'output': getattr(e, 'output', '')})
+    return {'jsonrpc': '2.0', 'result': result, 'id': request_id}
+
+def server_secret():
+    # Clients send it as "Authorization: Bearer <secret>", so only those who can read the file can act for the users
+    if os.path.exists(SERVER_SECRET_PATH):
+        with open(SERVER_SECRET_PATH) as secret_file:
+            secret = secret_file.read().strip()
+        if secret:
+            return secret
+    os.makedirs(os.path.dirname(SERVER_SECRET_PATH), exist_ok=True)
+    secret = lazy_import('secrets').token_urlsafe(32)
+    with open(os.open(SERVER_SECRET_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as secret_file:
+        secret_file.write(secret)
+    return secret
+
+def serve(engine, port=SERVER_PORT):
+    server_module = lazy_import('http.server')
+    secret = server_secret()
+    allowed_origins = {f"http://127.0.0.1:{port}", f"http://localhost:{port}"}
+
+    class RPCHandler(server_module.BaseHTTPRequestHandler):
+        def do_POST(self):
+            # Web pages can post to localhost without a preflight, so only JSON from local clients that know the secret is served
+            content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            authorization = self.headers.get('Authorization', '')
+            if self.headers.get('Origin') and self.headers['Origin'] not in allowed_origins:
+                return self.send_json(403, rpc_error(None, -32600, "Requests from web pages are not allowed"))
+            if content_type != 'application/json':
+                return self.send_json(415, rpc_error(None, -32600, "Content-Type must be application/json"))
+            if not lazy_import('hmac').compare_digest(authorization.encode(), f"Bearer {secret}".encode()):
+                return self.send_json(401, rpc_error(None, -32600, f"Send the secret in {SERVER_SECRET_PATH} as a Bearer token"))
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError:
+                response = rpc_error(None, -32700, "Parse error")
+            else:
+                if isinstance(request, list):
+                    response = [handle_rpc(engine, item) for item in request]
+                else:
+                    response = handle_rpc(engine, request)
+            self.send_json(200, response)
+
+        def send_json(self, status, response):
+            body = json.dumps(response, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    # Only listen locally, since requests act on the signed-in users' calendars
+    server = server_module.ThreadingHTTPServer(('127.0.0.1', port), RPCHandler)
+    print(f"Serving JSON-RPC on http://127.0.0.1:{port}/ (methods: run, commands).")
+    print(f"Requests need the header \"Authorization: Bearer <secret>\" with the secret saved in {SERVER_SECRET_PATH}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
 def parse_time(time_str):
     return datetime.datetime.strptime(time_str, "%H:%M").time()
 
@@ -641,10 +2893,11 @@ def parse_minutes(minutes_str):
     return datetime.timedelta(minutes=minutes)
 
 
-def parse_date_time(date_time_str, timezone_str='Etc/GMT-2'):
-    timezone = pytz.timezone(timezone_str)
-    date_time = parser.parse(date_time_str)
-    date_time = timezone.localize(date_time)
+def parse_date_time(date_time_str, timezone_str=None):
+    timezone = lazy_import('pytz').timezone(timezone_str or active_timezone())
+    date_time = lazy_import('dateutil.parser').parse(date_time_str)
+    if date_time.tzinfo is None:
+        date_time = timezone.localize(date_time)
     return date_time
 
 def calculate_time_with_delta(base_time, delta):
@@ -655,10 +2908,8 @@ def calculate_time_with_delta(base_time, delta):
 def scry(service):
     now = get_now().isoformat()
     print('Getting the upcoming 5 events')
-    events_result = service.events().list(calendarId='primary', timeMin=now,
-                                            maxResults=5, singleEvents=True,
-                                            orderBy='startTime').execute()
-    events = events_result.get('items', [])
+    sync_local_store(service)
+    events = stored_events_after(now, 5)
 
     print()
     if not events:
@@ -672,19 +2923,21 @@ def scry(service):
         print(start, event['summary'])
 
 
-def create_event(service, event_title, start_datetime, end_datetime, description="No description", reminder=None):
+def event_body(event_title, start_datetime, end_datetime, description="No description", reminder=None, location=None):
     event = {
         'summary': event_title,
         'description': description,
         'start': {
             'dateTime': start_datetime,
-            'timeZone': 'Etc/GMT-2',
+            'timeZone': active_timezone(),
         },
         'end': {
             'dateTime': end_datetime,
-            'timeZone': 'Etc/GMT-2',
+            'timeZone': active_timezone(),
         },
     }
+    if location:
+        event['location'] = location
 
     if reminder is not None:
         event['reminders'] = {
@@ -696,8 +2949,63 @@ def create_event(service, event_title, start_datetime, end_datetime, description
             'useDefault': False,
             'overrides': []
         }
-    event = service.events().insert(calendarId='primary', body=event).execute()
-    print('Event created: %s' % (event.get('htmlLink')))
+    return event
+
+def create_event(service, event_title, start_datetime, end_datetime, description="No description", reminder=None):
+    create_events(service, [event_body(event_title, start_datetime, end_datetime, description, reminder)])
+
+def create_events(service, event_bodies):
+    keys = queue_writes('insert', [(None, body, None) for body in event_bodies])
+    results = flush_write_queue(service, keys)
+    created_events = []
+    for key, body in zip(keys, event_bodies):
+        outcome, detail = results[key]
+        if outcome == 'done':
+            created_events.append(detail)
+            print('Event created: %s' % (detail.get('htmlLink') or detail['summary']))
+        elif outcome == 'pending':
+            print(f"Event '{body['summary']}' will be created when Google Calendar is reachable.")
+        else:
+            print(f"Event '{body['summary']}' could not be created: {detail}")
+    return created_events
+
+WEATHER_WORKERS = 8
+
+def weather_string_for_event(event, weather):
+    if weather is None:
+        return ""
+    place = f", {event['location']}" if event.get('location') else ""
+    return f"\n\nWeather ({readable_time(event['start_datetime'],'%Y-%m-%dT%H:%M:%S')}{place}):\nDescription: {weather['description']}\nTemperature: {weather['temperature']}°C"
+
+def add_events_to_calendar(service, events_json):
+    if not events_json:
+        return []
+    with ThreadPoolExecutor(max_workers=min(WEATHER_WORKERS, len(events_json))) as executor:
+        weathers = list(executor.map(with_tenant(lambda event: get_weather(event['start_datetime'], event.get('location'))), events_json))
+
+    event_bodies = []
+    for event, weather in zip(events_json, weathers):
+        reminder_input = event.get('reminder')
+        reminder = [{'method': 'popup', 'minutes': int(
+            reminder_input)}] if reminder_input else None
+        if isinstance(weather, str):
+            print(weather)
+            weather = None
+        weather_string = weather_string_for_event(event, weather)
+        if weather_string:
+            print(f"Weather details added to description{weather_string}")
+
+        start_time = parse_date_time(event['start_datetime'])
+        end_time = parse_date_time(event['end_datetime'])
+
+        if end_time <= get_now():
+            event['summary'] = "✅" + event['summary']
+
+        event_bodies.append(event_body(event['summary'], start_time.isoformat(),
+                                       end_time.isoformat(), event['description']+weather_string, reminder,
+                                       event.get('location')))
+
+    return create_events(service, event_bodies)
 
 def parse_time_input(time_input, default_time):
     if time_input.startswith("+"):
@@ -711,11 +3019,21 @@ def parse_time_input(time_input, default_time):
 def get_input(msg,default_value=None,default_msg=""):
     if not default_value == None:
         default_msg = f" (Default: {str(default_value)+default_msg})"
-    user_input = input(msg+default_msg+": ") or default_value
+    user_input = console_input(msg+default_msg+": ") or default_value
     if user_input == "" or user_input == None:
         return
+    if getattr(command_state, 'policy', None) is not None:
+        # Answers given ahead of time are plain answers, never console commands like exit or regret
+        return user_input
     if user_input == "exit" or user_input == "quit":
         exit()
+    if user_input == 'cache':
+        stats = llm_cache_stats()
+        print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses, {stats['bypassed']} bypassed ({stats['hit_rate']:.0%} hit rate).")
+        return get_input(msg, default_value)
+    if user_input == 'stats':
+        print_trace_stats()
+        return get_input(msg, default_value)
     if user_input == 'scry':
         raise ScryException()
     if user_input == 'regret':
@@ -739,69 +3057,81 @@ def get_input(msg,default_value=None,default_msg=""):
     return user_input
 
 
+record_startup_phase("load module", startup_started)
 
 if __name__ == '__main__':
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+    argument_parser = argparse.ArgumentParser(description="Plan your Google Calendar with GPT.")
+    argument_parser.add_argument('--startup-profile', action='store_true',
+                                 help="print where the time before the first prompt is spent.")
+    argument_parser.add_argument('--no-stream', action='store_true',
+                                 help="wait for complete responses instead of printing them as they arrive.")
+    argument_parser.add_argument('--no-local-time-window', action='store_true',
+                                 help="always ask GPT for the time window instead of parsing common phrasings locally.")
+    argument_parser.add_argument('--no-llm-cache', action='store_true',
+                                 help="always send prompts to OpenAI instead of reusing cached responses.")
+    argument_parser.add_argument('--refresh-weather', action='store_true',
+                                 help="keep the weather on the next week's events up to date in the background.")
+    argument_parser.add_argument('--serve', nargs='?', type=int, const=SERVER_PORT, metavar='PORT',
+                                 help=f"run headless and serve JSON-RPC on localhost (port {SERVER_PORT} by default).")
+    argument_parser.add_argument('--trace', metavar='PATH',
+                                 help="save timing spans on exit, as JSON Lines for .jsonl or a Chrome trace otherwise.")
+    argument_parser.add_argument('--calendar', default=default_calendar_id, metavar='ID',
+                                 help="the calendar to plan in (your primary calendar by default).")
+    argument_parser.add_argument('--timezone', default=default_timezone,
+                                 help=f"the timezone plans are made in ({default_timezone} by default).")
+    argument_parser.add_argument('--busy-calendars', nargs='+', default=[], metavar='ID',
+                                 help="also keep clear of the busy times in these calendars when finding free time.")
+    argument_parser.add_argument('--free-busy', action='store_true',
+                                 help="find free time for GET THEN MAKE from busy times alone, without reading the events in the window.")
+    argument_parser.add_argument('--sign-in', metavar='USER',
+                                 help="sign a team member in for --serve, saving their sign-in under tokens/.")
+    arguments = argument_parser.parse_args()
+    startup_profile = arguments.startup_profile
+    llm_cache_enabled = not arguments.no_llm_cache
+    stream_responses = not arguments.no_stream
+    local_time_windows = not arguments.no_local_time_window
+    if arguments.timezone != default_timezone and arguments.timezone not in lazy_import('pytz').all_timezones_set:
+        argument_parser.error(f"unknown timezone {arguments.timezone}")
+    default_calendar_id = arguments.calendar
+    default_timezone = arguments.timezone
+    busy_calendars = arguments.busy_calendars
+    free_busy_only = arguments.free_busy
+    if arguments.trace:
+        atexit.register(export_trace, arguments.trace)
 
     events = []
     try:
-        service = build('calendar', 'v3', credentials=creds)
+        if arguments.sign_in:
+            sign_in(arguments.sign_in)
+            sys.exit()
+        sessions = SessionPool()
+        service = sessions.get()
+        if pending_write_count():
+            print(f"Resuming {pending_write_count()} queued calendar change(s) in the background.")
+            for user in pending_write_users():
+                try:
+                    with acting_for(user or None):
+                        start_write_flusher(sessions.get(user or None))
+                except ValueError as e:
+                    print(f"Can't send the changes queued for {user}: {e}")
+        if arguments.refresh_weather:
+            start_weather_refresher(service)
+        if arguments.serve:
+            serve(CalendarEngine(sessions), arguments.serve)
+            sys.exit()
         print("Welcome to CalendarMe!")
         print("----------------------------")
+        record_startup_phase("first prompt", startup_started)
+        print(f"Ready in {STARTUP_TIMINGS[-1][1] * 1000:.0f} ms.")
+        if startup_profile:
+            for phase, seconds in STARTUP_TIMINGS:
+                print(f"[startup profile] {phase}: {seconds * 1000:.1f} ms")
         while True:
             try:
                 events_json = manual_planning_main(service)
 
                 if events_json is not None:
-                    for event in events_json:
-                        reminder_input = event.get('reminder')
-                        reminder = [{'method': 'popup', 'minutes': int(
-                            reminder_input)}] if reminder_input else None
-                        weather = get_weather(event['start_datetime'])
-                        weather_string = ""
-                        if weather is not None:
-                            weather_string = f"\n\nWeather ({readable_time(event['start_datetime'],'%Y-%m-%dT%H:%M:%S')}):\nDescription: {weather['description']}\nTemperature: {weather['temperature']}°C"
-                            print(f"Weather details added to description{weather_string}")
-                            creds = None
-                        """Shows basic usage of the Google Calendar API.
-                        Prints the start and name of the next 10 events on the user's calendar.
-                        """
-                        creds = None
-
-                        if os.path.exists('token.json'):
-                            creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-                        if not creds or not creds.valid:
-                            if creds and creds.expired and creds.refresh_token:
-                                creds.refresh(Request())
-                            else:
-                                flow = InstalledAppFlow.from_client_secrets_file(
-                                    'credentials.json', SCOPES)
-                                creds = flow.run_local_server(port=0)
-                            with open('token.json', 'w') as token:
-                                token.write(creds.to_json())
-                            with open('token.json', 'w') as token:
-                                token.write(creds.to_json())
-                            service = build('calendar', 'v3', credentials=creds)
-                        
-                        event_end_time = datetime.datetime.strptime(event['end_datetime'].split('T')[0] + " " + event['end_datetime'].split('T')[1][:8], '%Y-%m-%d %H:%M:%S')
-                        time_now = datetime.datetime.now()
-
-                        if event_end_time <= time_now:
-                            event['summary'] = "✅" + event['summary']
-
-                        create_event(service, event['summary'], event['start_datetime']+"+01:00",
-                                     event['end_datetime']+"+01:00", event['description']+weather_string, reminder)
+                    add_events_to_calendar(service, events_json)
             except ScryException:
                 scry(service)
             except RegretException:
@@ -814,5 +3144,5 @@ if __name__ == '__main__':
                 end_time = e.end_time
                 get_events_between_times(service, start_time, end_time)
 
-    except HttpError as error:
+    except http_error() as error:
         print('An error occurred: %s' % error)